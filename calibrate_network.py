@@ -0,0 +1,168 @@
+#!/usr/local/anaconda/bin/python
+
+# This script calibrates dam parameters (release limits and rule curve scaling) against observed streamflow at gauge cells, by KGE. Candidate parameter sets are simulated in memory (my_functions.simulate_gauge_flow) in parallel worker processes; only the results are written to disk
+
+import sys
+import numpy as np
+import pandas as pd
+import os
+import imp
+import multiprocessing
+import my_functions
+
+# KGE and USGS data reading from the result analysis functions
+analysis_functions = imp.load_source('analysis_functions', \
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                                     'result_analysis', 'my_functions.py'))
+
+# Default values of optional config options
+default_config = {'NETWORK': {'lag_method': 'round', \
+                              'diffusion': None, \
+                              'muskingum_x': None}, \
+                  'CALIBRATION': {'calib_dams': None, \
+                                  'max_flow_range': None, \
+                                  'min_flow_range': None, \
+                                  'rule_curve_scale_range': None, \
+                                  'population': 32, \
+                                  'n_generations': 20, \
+                                  'step_size': 0.2, \
+                                  'n_workers': 1, \
+                                  'seed': 0}}
+
+# Read in config file (same as reservoir_network.py, with a [CALIBRATION] section)
+cfg = my_functions.read_config(sys.argv[1], default_config=default_config)
+if 'CALIBRATION' not in cfg:
+    print 'Error: [CALIBRATION] section is needed!'
+    exit()
+
+#====================================================================#
+# Load dam and gauge information, and prepare the in-memory problem
+#====================================================================#
+#=== Load dam info and gauge info ===#
+df_dam_info = pd.read_csv(cfg['DAM_INFO']['dam_info_csv'])
+df_gauge_info = pd.read_csv(cfg['CALIBRATION']['gauge_csv'])
+ndam = len(df_dam_info)
+ngauge = len(df_gauge_info)
+#=== Natural flow, rule curves and routing to gauge cells over the calibration period ===#
+try:
+    problem, routing, dates_to_run = my_functions.setup_gauge_problem(\
+                                        cfg, df_dam_info, df_gauge_info['grid_lat'].values, \
+                                        df_gauge_info['grid_lon'].values)
+except ValueError as e:
+    print 'Error: {}'.format(e)
+    exit()
+
+#=== Load observed flow at gauges (daily) [cfs] ===#
+days = pd.to_datetime(np.unique(dates_to_run.normalize()))
+obs = np.full((ngauge, len(days)), np.nan)
+for g in range(ngauge):
+    df_usgs = analysis_functions.read_USGS_data(df_gauge_info.ix[g]['usgs_path'], \
+                                                columns=[int(df_gauge_info.ix[g]['usgs_col'])], \
+                                                names=['flow'])
+    obs[g] = df_usgs['flow'].reindex(days).values
+
+#=== Decision variables: (name, dam index) and range ===#
+if cfg['CALIBRATION']['calib_dams'] is None:
+    list_calib_dams = range(ndam)
+else:
+    list_calib_dams = [list(df_dam_info['dam_number'].values).index(n) \
+                       for n in np.atleast_1d(cfg['CALIBRATION']['calib_dams'])]
+list_variables = []
+list_range = []
+for name in ['max_flow', 'min_flow', 'rule_curve_scale']:
+    if cfg['CALIBRATION']['{}_range'.format(name)] is None:
+        continue
+    for i in list_calib_dams:
+        list_variables.append((name, i))
+        list_range.append(cfg['CALIBRATION']['{}_range'.format(name)])
+if len(list_variables)==0:
+    print 'Error: no decision variables (set max_flow_range, min_flow_range or rule_curve_scale_range)!'
+    exit()
+lower = np.array([r[0] for r in list_range], dtype=float)
+upper = np.array([r[1] for r in list_range], dtype=float)
+variable_names = ['{}_dam{}'.format(name, df_dam_info.ix[i]['dam_number']) for name, i in list_variables]
+print 'Decision variables: {}'.format(variable_names)
+problem['variables'] = list_variables
+
+#====================================================================#
+# Evaluate candidates in parallel and search
+#====================================================================#
+def evaluate(candidates):
+    ''' KGE of daily flow at each gauge for each candidate (candidate, gauge); worker processes inherit the problem '''
+    gauge_flow = my_functions.simulate_gauge_flow(problem, candidates)
+    # daily mean of each gauge
+    gauge_flow = gauge_flow.reshape(len(candidates), ngauge, len(days), -1).mean(axis=3)
+    score = np.full((len(candidates), ngauge), np.nan)
+    for c in range(len(candidates)):
+        for g in range(ngauge):
+            valid = ~np.isnan(obs[g])
+            score[c, g] = analysis_functions.kge(pd.Series(gauge_flow[c, g, valid]), \
+                                                 pd.Series(obs[g, valid]))
+    return score
+
+n_workers = cfg['CALIBRATION']['n_workers']
+population = cfg['CALIBRATION']['population']
+pool = multiprocessing.Pool(n_workers) if n_workers>1 else None
+random_state = np.random.RandomState(cfg['CALIBRATION']['seed'])
+x_default = np.clip(np.ones(len(list_variables)), lower, upper)  # default parameters
+step_size = cfg['CALIBRATION']['step_size']
+list_records = []
+best_x, best_score = None, -np.inf
+for generation in range(cfg['CALIBRATION']['n_generations']):
+    #=== Candidates: random in the range first, then around the best so far ===#
+    if best_x is None:
+        candidates = random_state.uniform(lower, upper, (population, len(lower)))
+        candidates[0] = x_default
+    else:
+        candidates = best_x + random_state.normal(size=(population, len(lower))) \
+                              * step_size * (upper - lower)
+        candidates = np.clip(candidates, lower, upper)
+        step_size *= 0.9  # narrow down the search
+    #=== Evaluate (one batch of candidates for each worker) ===#
+    list_batch = [batch for batch in np.array_split(candidates, n_workers) if len(batch)>0]
+    if pool is not None:
+        score = np.concatenate(pool.map(evaluate, list_batch))
+    else:
+        score = np.concatenate([evaluate(batch) for batch in list_batch])
+    objective = np.nanmean(score, axis=1)  # mean KGE over gauges
+    for c in range(population):
+        list_records.append([generation] + candidates[c].tolist() + score[c].tolist() + [objective[c]])
+    if np.nanmax(objective) > best_score:
+        best_score = np.nanmax(objective)
+        best_x = candidates[np.nanargmax(objective)]
+    print 'Generation {}: best mean KGE {:.4f}'.format(generation, best_score)
+if pool is not None:
+    pool.close()
+
+#====================================================================#
+# Save evaluations and the best parameters
+#====================================================================#
+gauge_names = [str(name) for name in df_gauge_info['gauge_name'].values]
+df_records = pd.DataFrame(list_records, columns=['generation'] + variable_names \
+                          + ['kge_{}'.format(name) for name in gauge_names] + ['kge_mean'])
+df_records.to_csv('{}.evaluations.txt'.format(cfg['CALIBRATION']['out_basepath']), \
+                  sep='\t', index=False)
+
+#=== KGE components of the best parameters at each gauge ===#
+gauge_flow = my_functions.simulate_gauge_flow(problem, best_x[np.newaxis, :])[0]
+gauge_flow = gauge_flow.reshape(ngauge, len(days), -1).mean(axis=2)
+for g in range(ngauge):
+    valid = ~np.isnan(obs[g])
+    components = analysis_functions.kge_component(pd.Series(gauge_flow[g, valid]), \
+                                                  pd.Series(obs[g, valid]))
+    print 'Gauge {}: KGE components (bias-1, variability ratio-1, correlation-1) {}'.format(gauge_names[g], np.round(components, 4))
+
+#=== Best parameters as a scenario table (see [SCENARIO] of reservoir_network.py) ===#
+df_best = pd.DataFrame({'scenario': 'calibrated', \
+                        'dam_number': df_dam_info['dam_number'].values, \
+                        'max_flow_cfs': problem['max_flow'], \
+                        'min_flow_cfs': problem['min_flow'], \
+                        'rule_curve_scale': np.ones(ndam)})
+for (name, i), x in zip(list_variables, best_x):
+    if name=='rule_curve_scale':
+        df_best.ix[i, 'rule_curve_scale'] = x
+    else:
+        df_best.ix[i, '{}_cfs'.format(name)] *= x
+df_best[['scenario', 'dam_number', 'max_flow_cfs', 'min_flow_cfs', 'rule_curve_scale']].to_csv(\
+        '{}.best_scenario.csv'.format(cfg['CALIBRATION']['out_basepath']), index=False)
+print 'Best mean KGE {:.4f}: {}'.format(best_score, dict(zip(variable_names, best_x)))
@@ -0,0 +1,40 @@
+#!/usr/local/anaconda/bin/python
+
+# This script checks that step-by-step reservoir operation (my_functions.ReservoirState, ReservoirStateBatch) and the operation kernels (compiled and pure Python) give identical release and storage, for the dams of a reservoir_network.py config file at its time step, on a synthetic series (see my_functions.check_operation_equivalence). It is a standalone check to run after changing the operation code; reservoir_network.py does not run it
+
+import sys
+import xray
+import pandas as pd
+import my_functions
+
+# Read in config file (same as reservoir_network.py)
+cfg = my_functions.read_config(sys.argv[1])
+
+#=== Load dam info ===#
+df_dam_info = pd.read_csv(cfg['DAM_INFO']['dam_info_csv'])
+
+#=== Time step of the flow data (of the first member, for an ensemble) [s] ===#
+list_members = my_functions.find_rvic_output_paths(cfg['INPUT']['rvic_output_path'])
+if list_members is not None and len(list_members)==0:
+    print 'Error: no RVIC output file found for the ensemble!'
+    exit()
+ds_rvic = xray.open_dataset(cfg['INPUT']['rvic_output_path'] if list_members is None \
+                            else list_members[0])
+ds_rvic = ds_rvic.isel(time=slice(0,-1))   # delete last junk date
+try:
+    dt_seconds = my_functions.calc_time_step(pd.to_datetime(ds_rvic['time'].values))
+except ValueError:
+    print 'Error: time steps of RVIC output are not uniform!'
+    exit()
+
+#=== Check each dam ===#
+try:
+    my_functions.check_operation_equivalence(df_dam_info['top_vol_acre_feet'].values * 43560.0, \
+                                             df_dam_info['bot_vol_acre_feet'].values * 43560.0, \
+                                             df_dam_info['max_flow_cfs'].values, \
+                                             df_dam_info['min_flow_cfs'].values, dt=dt_seconds)
+except ValueError as e:
+    print 'Error: {}'.format(e)
+    exit()
+print 'Step-by-step operation and the kernels give identical release and storage for all {} dams'.format(\
+                                                                                len(df_dam_info))
@@ -118,27 +118,135 @@ def process_rule_curve(path, start_date, end_date):
     Return:
         a pd.Series with dates as index and rule curve storage as data [acre-feet]
 
+    Require:
+        expand_rule_curve
     '''
 
-    import pandas as pd
     import numpy as np
 
     rule_curve_annual = np.loadtxt(path, skiprows=1)  # Load annual rule curve data
-    s_rule_curve = pd.Series(index=pd.date_range(start_date,end_date))  # create empty Series
 
-    # loop over each day of year
-    for i in range(len(rule_curve_annual)):
-        month = int(rule_curve_annual[i,0])
-        day = int(rule_curve_annual[i,1])
-        s_rule_curve.loc[(s_rule_curve.index.month==month) & (s_rule_curve.index.day==day)] = rule_curve_annual[i,2]
-    s_rule_curve.loc[(s_rule_curve.index.month==2) & (s_rule_curve.index.day==29)] = rule_curve_annual[58,2] # set 2/29 equal to 2/28
+    return expand_rule_curve(rule_curve_annual, start_date, end_date)
+
+#====================================================================#
+#====================================================================#
+
+def expand_rule_curve(rule_curve_annual, start_date, end_date):
+    ''' This function expands 365 days of rule curve storage to a time series for the whole time range desired, by one vectorized lookup of (month, day) for all dates
+
+    Input:
+        rule_curve_annual: np.array of annual rule curve (365 rows: <month> <day> <data [acre-feet]>)
+        start_date, end_date: start and end date for reservoir operation simulation [dt.datetime]
+
+    Return:
+        a pd.Series with dates as index and rule curve storage as data [acre-feet]
+    '''
+
+    import pandas as pd
+    import numpy as np
+
+    #=== Build (month, day) lookup table ===#
+    table = np.full((13, 32), np.nan)
+    table[rule_curve_annual[:,0].astype(int), rule_curve_annual[:,1].astype(int)] = \
+            rule_curve_annual[:,2]
+    table[2, 29] = rule_curve_annual[58,2] # set 2/29 equal to 2/28
+
+    #=== Look up all dates at once ===#
+    dates = pd.date_range(start_date,end_date)
+    s_rule_curve = pd.Series(table[np.asarray(dates.month), np.asarray(dates.day)], index=dates)
 
     return s_rule_curve
 
 #====================================================================#
 #====================================================================#
 
-def simulate_reservoir_operation(orig_flow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow):
+def read_rule_curve_store(path):
+    ''' This function reads a binary store of parsed annual rule curves (see write_rule_curve_store)
+
+    Input:
+        path: path of the store file (.npz); if the file does not exist, an empty store is returned
+
+    Return:
+        a dict of dam_number -> {'path': rule curve file path, 'mtime': file modification time, 'data': np.array of annual rule curve}
+    '''
+
+    import numpy as np
+    import os
+
+    store = {}
+    if not os.path.isfile(path):
+        return store
+
+    npz = np.load(path)
+    offset = np.append(0, np.cumsum(npz['n_rows']))
+    for i, dam_number in enumerate(npz['dam_number']):
+        store[int(dam_number)] = {'path': str(npz['path'][i]), \
+                                  'mtime': float(npz['mtime'][i]), \
+                                  'data': npz['data'][offset[i]:offset[i+1]]}
+    npz.close()
+
+    return store
+
+#====================================================================#
+#====================================================================#
+
+def write_rule_curve_store(path, store):
+    ''' This function writes parsed annual rule curves of all dams into one compact binary file (.npz)
+
+    Input:
+        path: path of the store file (written as is, with or without the .npz suffix)
+        store: dict of dam_number -> {'path', 'mtime', 'data'} (see read_rule_curve_store)
+    '''
+
+    import numpy as np
+
+    list_dam_number = sorted(store.keys())
+    # write through a file handle, so that np.savez does not append '.npz' to the path
+    with open(path, 'wb') as f:
+        np.savez(f, \
+                 dam_number=np.array(list_dam_number, dtype=int), \
+                 path=np.array([store[n]['path'] for n in list_dam_number], dtype=str), \
+                 mtime=np.array([store[n]['mtime'] for n in list_dam_number], dtype=float), \
+                 n_rows=np.array([len(store[n]['data']) for n in list_dam_number], dtype=int), \
+                 data=np.concatenate([store[n]['data'] for n in list_dam_number]) \
+                      if len(list_dam_number)>0 else np.empty((0, 3)))
+
+#====================================================================#
+#====================================================================#
+
+def load_rule_curve_annual(path, dam_number, store=None):
+    ''' This function loads annual rule curve of a dam; if a rule curve store is given, the file is only parsed if it is not in the store or has changed since it was stored
+
+    Input:
+        path: annual rule curve data path
+              (365 days: <month> <day> <data [acre-feet]>, with a header line)
+        dam_number: dam number (key in the store)
+        store: rule curve store (see read_rule_curve_store), updated in place; None for no caching
+
+    Return:
+        np.array of annual rule curve (<month> <day> <data [acre-feet]>)
+    '''
+
+    import numpy as np
+    import os
+
+    if store is None:
+        return np.loadtxt(path, skiprows=1)
+
+    mtime = os.path.getmtime(path)
+    entry = store.get(int(dam_number))
+    if entry is not None and entry['path']==path and entry['mtime']==mtime:
+        return entry['data']
+
+    rule_curve_annual = np.loadtxt(path, skiprows=1)
+    store[int(dam_number)] = {'path': path, 'mtime': mtime, 'data': rule_curve_annual}
+
+    return rule_curve_annual
+
+#====================================================================#
+#====================================================================#
+
+def simulate_reservoir_operation(orig_flow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow, dt=86400.0, diagnostics=None):
     ''' This function simulates reservoir operation and generates modified release flow;
         only simulates period of time specified by input rule curve time range
 
@@ -150,6 +258,8 @@ def simulate_reservoir_operation(orig_flow, rule_curve, init_S, top_vol, bot_vol
         bot_vol: bottom volumn of reservoir [acre-feet]
         max_flow: maximum allowed release [cfs]
         min_flow: minimum allowed release [cfs]
+        dt: length of a time step [s]; time steps of orig_flow and rule_curve
+        diagnostics: optional np.array of length len(DIAGNOSTIC_NAMES); if given, filled in place with the operational diagnostics of the period (see DIAGNOSTIC_NAMES)
 
     Return:
         release, storage: pd.Series of flow release [cfs] and reservoir storage [acre-feet]
@@ -157,6 +267,7 @@ def simulate_reservoir_operation(orig_flow, rule_curve, init_S, top_vol, bot_vol
 
     Require:
         select_time_range(data, start_datetime, end_datetime)
+        reservoir_operation_kernel
     '''
 
     import pandas as pd
@@ -172,151 +283,2618 @@ def simulate_reservoir_operation(orig_flow, rule_curve, init_S, top_vol, bot_vol
     end_date_to_run = rule_curve.index[-1]
     inflow = select_time_range(orig_flow, start_date_to_run, end_date_to_run)    
 
-    #=== Initialize ===#
-    storage = pd.Series(index=pd.date_range(start_date_to_run,end_date_to_run))  # initialize storage ts [acre-feet]
-    release = pd.Series(index=pd.date_range(start_date_to_run,end_date_to_run))  # initialize release ts [cfs]
+    #=== Run reservoir operation on plain arrays ===#
+    release, storage = reservoir_operation_kernel(inflow.values, rule_curve.values, \
+                                    init_S, top_vol, bot_vol, max_flow, min_flow, dt=dt, \
+                                    diagnostics=diagnostics)
+
+    #=== Put results back to time series ===#
+    release = pd.Series(release, index=rule_curve.index)  # [cfs]
+    storage = pd.Series(storage, index=rule_curve.index)  # [acre-feet]
+
+    return release, storage
+
+#====================================================================#
+#====================================================================#
+
+# Operational diagnostics accumulated during reservoir operation (one value of each for each dam):
+#   steps_at_min_release - time steps with release at or below the minimum flow
+#   steps_at_max_release - time steps with release at or above the maximum flow
+#   steps_below_rule_curve - time steps ending with storage below the rule curve
+#   steps_at_bot_vol - time steps releasing all water available above the bottom volumn
+#   steps_in_flood_capacity - time steps ending with storage above the rule curve (in flood capacity)
+#   max_flood_capacity_use - maximum fraction of the flood capacity (rule curve to top volumn) used
+#   max_spill_cfs - maximum release above the maximum flow (flood release) [cfs]
+# (the mass balance is not among them: within the operation it holds by construction; see
+# calc_mass_balance_residual for a check against the output flow field and storage)
+DIAGNOSTIC_NAMES = ['steps_at_min_release', 'steps_at_max_release', 'steps_below_rule_curve', \
+                    'steps_at_bot_vol', 'steps_in_flood_capacity', 'max_flood_capacity_use', \
+                    'max_spill_cfs']
+
+#====================================================================#
+#====================================================================#
+
+# Let numba compile the one-step helper into the compiled loop (see _reservoir_operation_loop);
+# without numba it stays a plain Python function
+try:
+    from numba.extending import register_jitable as _register_jitable
+except ImportError:
+    def _register_jitable(func):
+        return func
+
+@_register_jitable
+def _reservoir_operation_step(S, inflow, rule_target, top_vol, bot_vol, max_flow, min_flow, dt, diagnostics):
+    ''' One time step of the default release logic for one reservoir, shared by _reservoir_operation_loop and ReservoirState.step so that both give identical numbers; accumulates diagnostics in place
+
+    Input:
+        S: storage before the time step [ft3]
+        inflow: inflow to reservoir of the time step [cfs]
+        rule_target: rule curve storage of the time step [ft3]
+        top_vol, bot_vol: top and bottom storage [ft3]
+        max_flow, min_flow: maximum and minimum allowed release [cfs]
+        dt: length of a time step [s] (86400 for daily)
+        diagnostics: container of length len(DIAGNOSTIC_NAMES); accumulated in place
+
+    Return:
+        S: storage at the end of the time step [ft3]
+        release: release of the time step [cfs]
+        storage: storage at the end of the time step [acre-feet]
+    '''
+
+    # Maximum available water to release
+    max_avail = S + inflow*dt - bot_vol  # [ft3/step]
+    # Rease required to bring storage to rule curve
+    rule_req = max(0, S + inflow*dt - rule_target)  # [ft3/step]
+    # Additional flood max capacity
+    flood_cap = top_vol - rule_target  # [ft3]
+    # Step 1 - preliminary release
+    prelim_release = min(max_avail, max(rule_req, min_flow*dt))  # [ft3/step]
+    # Step 2 - final release (check flood)
+    reduced_release = max(max_flow*dt, prelim_release - flood_cap)  # [ft3/step]
+    if prelim_release <= max_flow*dt:
+        final_release = prelim_release
+    else:
+        final_release = reduced_release  # [ft3/step]
+    # Update storage
+    S = S + inflow*dt - final_release
+    release = final_release / dt  # convert to [cfs]
+    storage = S / 43560.0  # convert [ft3] to [acre-feet]
+    # Accumulate diagnostics (see DIAGNOSTIC_NAMES)
+    if final_release <= min_flow*dt:
+        diagnostics[0] += 1
+    if final_release >= max_flow*dt:
+        diagnostics[1] += 1
+    if S < rule_target:
+        diagnostics[2] += 1
+    if final_release >= max_avail:
+        diagnostics[3] += 1
+    if S > rule_target:
+        diagnostics[4] += 1
+        if flood_cap > 0:
+            diagnostics[5] = max(diagnostics[5], (S - rule_target) / flood_cap)
+    diagnostics[6] = max(diagnostics[6], release - max_flow)
+
+    return S, release, storage
+
+#====================================================================#
+#====================================================================#
+
+def _reservoir_operation_loop(inflow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow, release, storage, dt, diagnostics):
+    ''' Step-by-step loop of reservoir operation; fills in release, storage and diagnostics in place.
+        Written with plain indexing and builtin min/max so that it runs either on
+        Python lists or, compiled by numba, on numpy arrays (see reservoir_operation_kernel)
+
+    Input:
+        inflow: inflow to reservoir [cfs]
+        rule_curve: rule curve storage [ft3]; same length as inflow
+        init_S, top_vol, bot_vol: initial, top and bottom storage [ft3]
+        max_flow, min_flow: maximum and minimum allowed release [cfs]
+        release, storage: output containers with the same length as inflow
+                          (release [cfs]; storage [acre-feet])
+        dt: length of a time step [s] (86400 for daily)
+        diagnostics: container of length len(DIAGNOSTIC_NAMES), starting from 0; accumulated in place
+
+    Return:
+        S: storage at the end of the last time step [ft3]
+
+    Require:
+        _reservoir_operation_step
+    '''
+
     S = init_S
 
-    #=== Loop over each day ===#
+    #=== Loop over each time step ===#
     for t in range(len(rule_curve)):
-        # Maximum available water to release
-        max_avail = S + inflow[t]*86400 - bot_vol  # [ft3/day]
-        # Rease required to bring storage to rule curve
-        rule_req = max(0, S + inflow[t]*86400 - rule_curve[t])  # [ft3/day]
-        # Additional flood max capacity
-        flood_cap = top_vol - rule_curve[t]  # [ft3]
-        # Step 1 - preliminary release
-        prelim_release = min(max_avail, max(rule_req, min_flow*86400))  # [ft3/day]
-        # Step 2 - final release (check flood)
-        reduced_release = max(max_flow*86400, prelim_release - flood_cap)  # [ft3/day]
-        if prelim_release <= max_flow*86400:
-            final_release = prelim_release
-        else:
-            final_release = reduced_release  # [ft3/day]
-        release[t] = final_release / 86400.0  # convert to [cfs]
-        # Update storage
-        S = S + inflow[t]*86400 - final_release
-        storage[t] = S / 43560.0  # convert [ft3] to [acre-feet]
+        S, release_t, storage_t = _reservoir_operation_step(S, inflow[t], rule_curve[t], top_vol, \
+                                            bot_vol, max_flow, min_flow, dt, diagnostics)
+        release[t] = release_t  # [cfs]
+        storage[t] = storage_t  # [acre-feet]
 
-    return release, storage
+    return S
+
+# Compile the loop if numba is available; otherwise keep the pure Python version
+try:
+    import numba
+    _reservoir_operation_loop_jit = numba.njit(cache=True)(_reservoir_operation_loop)
+except ImportError:
+    _reservoir_operation_loop_jit = None
 
 #====================================================================#
 #====================================================================#
 
-def find_downstream_grid(da_flowdir, lat, lon, dlatlon):
-    ''' This function finds the immediate downstream grid cell based on 1-8 formatted flow direction
+def reservoir_operation_kernel(inflow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow, use_jit=True, dt=86400.0, diagnostics=None):
+    ''' This function runs the same two-step release logic as simulate_reservoir_operation, but on plain arrays (no pandas indexing, no unit conversion)
+
     Input:
-        da_flowdir: xray.DataArray of flow direction file (1-8 format)
-        lat, lon: lat and lon of the current grid cell
-        dlatlon: delta lat and lon (e.g., 0.125)
+        inflow: np.array of inflow to reservoir [cfs]
+        rule_curve: np.array of rule curve storage [ft3]; same length as inflow
+        init_S: initial storage in the reservoir [ft3]
+        top_vol: top volumn of reservoir [ft3]
+        bot_vol: bottom volumn of reservoir [ft3]
+        max_flow: maximum allowed release [cfs]
+        min_flow: minimum allowed release [cfs]
+        use_jit: True for using the numba-compiled loop if numba is installed;
+                 False for always using the pure Python loop
+        dt: length of a time step [s] (86400 for daily)
+        diagnostics: optional np.array of length len(DIAGNOSTIC_NAMES); if given, filled in place with the operational diagnostics (see DIAGNOSTIC_NAMES), accumulated in the same loop
 
     Return:
-        lat, lon: lat lon of the immediate downstream grid cell
-                  (if the current grid cell is an outlet, return -999, -999)
+        release, storage: np.array of flow release [cfs] and reservoir storage [acre-feet]
 
+    Require:
+        _reservoir_operation_loop
     '''
 
     import numpy as np
 
-    #=== Extract flow direction of the current grid cell ===#
-    flowdir = int(da_flowdir.loc[lat, lon].values)
+    inflow = np.asarray(inflow, dtype=float)
+    rule_curve = np.asarray(rule_curve, dtype=float)
+    if len(inflow) != len(rule_curve):
+        raise ValueError('inflow and rule_curve must have the same length')
 
-    #=== Identify the next grid cell ===#
-    lat_next, lon_next = lat, lon  # initialize
-    if flowdir not in [1,2,3,4,5,6,7,8]:  # if don't have valid direction, then it's an outlet
-        return -999, -999
+    if use_jit and _reservoir_operation_loop_jit is not None:
+        release = np.empty(len(rule_curve))
+        storage = np.empty(len(rule_curve))
+        diag = np.zeros(len(DIAGNOSTIC_NAMES))
+        _reservoir_operation_loop_jit(inflow, rule_curve, float(init_S), float(top_vol), \
+                                      float(bot_vol), float(max_flow), float(min_flow), \
+                                      release, storage, float(dt), diag)
     else:
-        # Process lat
-        if flowdir in [1,2,8]:
-            lat_next = lat + dlatlon
-        elif flowdir in [4,5,6]:
-            lat_next = lat - dlatlon
-        # Process lon
-        if flowdir in [2,3,4]:
-            lon_next = lon + dlatlon
-        elif flowdir in [6,7,8]:
-            lon_next = lon - dlatlon
+        # Python floats in lists are much cheaper to index than numpy scalars
+        release = [0.0] * len(rule_curve)
+        storage = [0.0] * len(rule_curve)
+        diag = [0.0] * len(DIAGNOSTIC_NAMES)
+        _reservoir_operation_loop(inflow.tolist(), rule_curve.tolist(), float(init_S), \
+                                  float(top_vol), float(bot_vol), float(max_flow), \
+                                  float(min_flow), release, storage, float(dt), diag)
+        release = np.array(release)
+        storage = np.array(storage)
+    if diagnostics is not None:
+        diagnostics[:] = diag
 
-    #=== Check if the next grid cell is still within basin ===#
-    if da_flowdir.loc[lat_next,lon_next].values not in [1,2,3,4,5,6,7,8]:  
-    # if the next cell outside of basin
-        return -999, -999
-    else:  # if the next cell still within the basin
-        return lat_next, lon_next
+    return release, storage
 
 #====================================================================#
 #====================================================================#
 
-def modify_flow_all_downstream_cell(lat, lon, orig_flow, release, da_flow, dlatlon, da_flowdir, da_flowdis, velocity):
-    ''' This function modifies flow at all downstream cells from an operated dam
+def reservoir_operation_kernel_batch(inflow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow, start_index=None, use_jit=True, final_S=None, dt=86400.0, policy=None, sea=None, hydro=None, diagnostics=None, init_release=None):
+    ''' This function simulates a batch of independent reservoirs in one call on (dam, time) arrays; each dam follows the same release logic as reservoir_operation_kernel, or the operating policy if given
 
     Input:
-        lat, lon: lat and lon of the dam
-        orig_flow: pd.Series of original inflow at the dam [cfs]
-        release: pd.Series of simulated release at the dam [cfs]; only for period with operation
-        da_flow: xray.DataArray of original streamflow field (time, lat, lon)
-        dlatlon: delta lat and lon (e.g., 0.125)
-        da_flowdir: xray.DataArray of flow direction file (1-8 format)
-        da_flowdis: xray.DataArray of flow distance file [m]
-        velocity: wave velocity [m/s]
+        inflow: 2-D np.array of inflow to each reservoir (dam, time) [cfs]
+        rule_curve: 2-D np.array of rule curve storage (dam, time) [ft3]
+        init_S: initial storage of each reservoir [ft3]
+        top_vol: top volumn of each reservoir [ft3]
+        bot_vol: bottom volumn of each reservoir [ft3]
+        max_flow: maximum allowed release of each reservoir [cfs]
+        min_flow: minimum allowed release of each reservoir [cfs]
+                  (init_S, top_vol, bot_vol, max_flow and min_flow are scalars or 1-D arrays of length ndam; scalars are broadcast across dams)
+        start_index: time index at which each dam starts operation (scalar or 1-D array of length ndam); init_S is the storage at that time step. Default: 0 for all dams
+        use_jit: True for looping the numba-compiled kernel over dams if numba is installed;
+                 False for always using the vectorized numpy sweep over time
+        final_S: optional np.array of length ndam; if given, filled in place with the storage of each dam at the end of the last time step [ft3] (e.g., to continue the simulation later)
+        dt: length of a time step [s] (86400 for daily)
+        policy: operating policy for the dams of the batch (see ReleasePolicy); None for the default release logic. A policy always runs in the vectorized numpy sweep (time index t of the policy is the time index of inflow)
+        sea: StorageElevationArea of the dams of the batch; None for no water level and hydropower
+        hydro: optional dict; if given with sea, filled with 2-D np.array (dam, time) of 'elevation' [ft], 'area' [acres], 'head' [ft] and 'power' [MW] (see StorageElevationArea.evaluate), looked up in the same sweep
+        diagnostics: optional 2-D np.array (dam, len(DIAGNOSTIC_NAMES)); if given, filled in place with the operational diagnostics of each dam (see DIAGNOSTIC_NAMES), accumulated in the same sweep
+        init_release: release of each dam on the time step before the first one [cfs] (scalar or 1-D array of length ndam), read by the policy as the state's last release (e.g., to continue a ramp-rate limit from the previous time chunk; see ReservoirStateBatch). Default: NaN (no earlier release)
 
-    Return: xray.DataArray of modified streamflow field after this dam is operated
-            (time, lat, lon)
+    Return:
+        release, storage: 2-D np.array of flow release [cfs] and reservoir storage [acre-feet] (dam, time); NaN before each dam starts operation
 
     Require:
-        find_downstream_grid(da_flowdir, lat, lon, dlatlon)
+        _reservoir_operation_loop
+        ReservoirStateBatch
+        StorageElevationArea
+    '''
+
+    import numpy as np
+
+    inflow = np.atleast_2d(np.asarray(inflow, dtype=float))
+    rule_curve = np.atleast_2d(np.asarray(rule_curve, dtype=float))
+    if inflow.shape != rule_curve.shape:
+        raise ValueError('inflow and rule_curve must have the same (dam, time) shape')
+    ndam, ntime = inflow.shape
+
+    #=== Broadcast per-dam parameters ===#
+    if start_index is None:
+        start_index = 0
+    init_S, top_vol, bot_vol, max_flow, min_flow = \
+        [np.broadcast_to(np.asarray(x, dtype=float), (ndam,)).copy() \
+         for x in [init_S, top_vol, bot_vol, max_flow, min_flow]]
+    start_index = np.broadcast_to(np.asarray(start_index, dtype=int), (ndam,))
+
+    release = np.full((ndam, ntime), np.nan)
+    storage = np.full((ndam, ntime), np.nan)
+    diag = np.zeros((ndam, len(DIAGNOSTIC_NAMES)))
+
+    #=== numba available - loop the compiled kernel over dams (default release logic only) ===#
+    if use_jit and _reservoir_operation_loop_jit is not None and policy is None:
+        for d in range(ndam):
+            t0 = start_index[d]
+            S_end = _reservoir_operation_loop_jit(inflow[d, t0:], rule_curve[d, t0:], init_S[d], \
+                                          top_vol[d], bot_vol[d], max_flow[d], min_flow[d], \
+                                          release[d, t0:], storage[d, t0:], float(dt), diag[d])
+            if final_S is not None:
+                final_S[d] = S_end
+        if diagnostics is not None:
+            diagnostics[:] = diag
+        # Water level and hydropower of all dams and time steps in one vectorized lookup
+        if sea is not None and hydro is not None:
+            hydro['elevation'], hydro['area'], hydro['head'], hydro['power'] = \
+                sea.evaluate(storage, release)
+        return release, storage
+
+    #=== Otherwise - one vectorized sweep over the time axis ===#
+    # Work on time-major copies so that each time step reads contiguous memory
+    inflow_t = np.ascontiguousarray(inflow.T)
+    rule_curve_t = np.ascontiguousarray(rule_curve.T)
+    release_t = np.full((ntime, ndam), np.nan)
+    storage_t = np.full((ntime, ndam), np.nan)
+    use_sea = sea is not None and hydro is not None
+    if use_sea:
+        hydro_t = dict((key, np.full((ntime, ndam), np.nan)) \
+                       for key in ['elevation', 'area', 'head', 'power'])
+    state = ReservoirStateBatch(np.full(ndam, np.nan), top_vol, bot_vol, max_flow, min_flow, dt, policy)
+    if init_release is not None:
+        state.release = np.broadcast_to(np.asarray(init_release, dtype=float), (ndam,)).copy()
+    state.diagnostics = diag
+    for t in range(start_index.min(), ntime):
+        # Set initial storage for dams starting operation at this time step
+        state.S = np.where(start_index==t, init_S, state.S)
+        state.t = t
+        release_t[t], storage_t[t] = state.step(inflow_t[t], rule_curve_t[t])
+        if use_sea:
+            hydro_t['elevation'][t], hydro_t['area'][t], hydro_t['head'][t], \
+                hydro_t['power'][t] = sea.evaluate(storage_t[t], release_t[t])
+    S = state.S
+
+    #=== Mask out time steps before operation ===#
+    not_started = np.arange(ntime)[:, np.newaxis] < start_index[np.newaxis, :]
+    release_t[not_started] = np.nan
+    storage_t[not_started] = np.nan
+    if final_S is not None:
+        final_S[:] = np.where(start_index<ntime, S, init_S)
+    if diagnostics is not None:
+        diagnostics[:] = diag
+    if use_sea:
+        for key in hydro_t:
+            hydro_t[key][not_started] = np.nan
+            hydro[key] = hydro_t[key].T.copy()
+
+    return release_t.T.copy(), storage_t.T.copy()
+
+#====================================================================#
+#====================================================================#
+
+class ReservoirState(object):
+    ''' Operation state of one reservoir, advanced one time step at a time (e.g., for a real-time feed, one day of inflow at a time); step() follows the same release logic as reservoir_operation_kernel and gives identical numbers
 
+    Attributes:
+        S: current storage in the reservoir [ft3]
+        top_vol, bot_vol: top and bottom volumn of reservoir [ft3]
+        max_flow, min_flow: maximum and minimum allowed release [cfs]
+        dt: length of a time step [s] (86400 for daily)
+        diagnostics: None (default), or np.array of length len(DIAGNOSTIC_NAMES) set by the caller, accumulated in place by step() (see DIAGNOSTIC_NAMES)
     '''
 
-    import pandas as pd
-    import datetime as dt
+    __slots__ = ('S', 'top_vol', 'bot_vol', 'max_flow', 'min_flow', 'dt', 'diagnostics')
 
-    #=== Find period with reservoir operation ===#
-    start_date_to_run = release.index[0]
-    end_date_to_run = release.index[-1]
+    def __init__(self, init_S, top_vol, bot_vol, max_flow, min_flow, dt=86400.0):
+        self.S = float(init_S)
+        self.top_vol = float(top_vol)
+        self.bot_vol = float(bot_vol)
+        self.max_flow = float(max_flow)
+        self.min_flow = float(min_flow)
+        self.dt = float(dt)
+        self.diagnostics = None
 
-    #=== Calculate delta flow ===#
-    s_dflow = release - orig_flow[pd.date_range(start_date_to_run, end_date_to_run)]
+    def step(self, inflow, rule_target):
+        ''' This function operates the reservoir for one time step and updates storage
 
-    #=== Modify flow at the first grid cell (i.e., the dam grid cell) ===#
-    da_flow.loc[pd.date_range(start_date_to_run, end_date_to_run),lat,lon] = release
+        Input:
+            inflow: inflow to reservoir of this time step [cfs]
+            rule_target: rule curve storage of this time step [ft3]
 
-    #=== Initialize flow distance from the dam to the current downstream grid cell [m] ===#
-    fdis = 0
+        Return:
+            release: flow release of this time step [cfs]
+            storage: reservoir storage at the end of this time step [acre-feet]
 
-    #=== Move to the immediate downstream grid cell ===#
-    lat_current, lon_current = find_downstream_grid(da_flowdir, lat, lon, dlatlon)
-    if lat_current==-999 and lon_current==-999:
-    # if the immediate downstream grid cell is outside of the basin, 
-    # done with all modification for this dam
-        return da_flow
+        Require:
+            _reservoir_operation_step
+        '''
 
-    #=== Loop over each downstream grid cell, and modify flow ===#
-    while 1:
-        #=== Identify time lag (to flow from dam to the current grid cell) ===#
-        fdis = fdis + da_flowdis.loc[lat_current, lon_current]
-        lag_days = int(round(fdis / velocity / 86400.0))  # [day], precise to integer days
-        #=== Modify flow for the current grid cell ===#
-        # Identify lagged time range
-        start_date_lagged = start_date_to_run + dt.timedelta(days=lag_days)
-        end_date_lagged = end_date_to_run + dt.timedelta(days=lag_days)
-        # Modify flow for this grid cell
-        if (end_date_lagged-orig_flow.index[-1]).days <= 0: # if within orig_flow time range
-            da_flow.loc[pd.date_range(start_date_lagged, end_date_lagged),lat_current,lon_current] \
-                    += s_dflow.values
-        else:   # if later than orig_flow time range
-            days_to_modify = (orig_flow.index[-1] - start_date_lagged).days + 1
-            da_flow.loc[pd.date_range(start_date_lagged, orig_flow.index[-1]),\
-                                      lat_current,lon_current] \
-                    += s_dflow.values[0:days_to_modify]
-        #=== Move to the next downstream grid cell ===#
-        lat_current, lon_current = find_downstream_grid(da_flowdir, \
-                                        lat_current, lon_current, dlatlon)
-        if lat_current==-999 and lon_current==-999:
-        # if the immediate downstream grid cell is outside of the basin, 
-        # done with all modification for this dam
-            break
-    return da_flow
+        diagnostics = self.diagnostics if self.diagnostics is not None \
+                      else [0.0] * len(DIAGNOSTIC_NAMES)  # not kept
+        self.S, release, storage = _reservoir_operation_step(self.S, float(inflow), float(rule_target), \
+                                        self.top_vol, self.bot_vol, self.max_flow, self.min_flow, \
+                                        self.dt, diagnostics)
+
+        return release, storage
+
+#====================================================================#
+#====================================================================#
+
+class ReservoirStateBatch(object):
+    ''' Operation state of several independent reservoirs, advanced one time step at a time for all of them together; the vectorized variant of ReservoirState (identical numbers for each reservoir with the default policy)
+
+    Attributes:
+        S: np.array of current storage of each reservoir [ft3]
+        top_vol, bot_vol: np.array of top and bottom volumn of each reservoir [ft3]
+        max_flow, min_flow: np.array of maximum and minimum allowed release of each reservoir [cfs]
+        dt: length of a time step [s] (86400 for daily)
+        policy: operating policy deciding the release (see ReleasePolicy); default: ReleasePolicy(); its parameters are checked against the reservoirs (see ReleasePolicy.check; ValueError if not valid)
+        release: np.array of release of each reservoir of the last time step [cfs]; NaN before the first step
+        t: time index of the next step (advanced by step(); can be set by the caller)
+        diagnostics: None (default), or 2-D np.array (reservoir, len(DIAGNOSTIC_NAMES)) set by the caller, accumulated in place by step() (see DIAGNOSTIC_NAMES)
+    '''
+
+    __slots__ = ('S', 'top_vol', 'bot_vol', 'max_flow', 'min_flow', 'dt', 'policy', 'release', 't', \
+                 'diagnostics')
+
+    def __init__(self, init_S, top_vol, bot_vol, max_flow, min_flow, dt=86400.0, policy=None):
+        import numpy as np
+        self.S = np.array(init_S, dtype=float)
+        self.dt = float(dt)
+        ndam = len(self.S)
+        self.top_vol, self.bot_vol, self.max_flow, self.min_flow = \
+            [np.broadcast_to(np.asarray(x, dtype=float), (ndam,)).copy() \
+             for x in [top_vol, bot_vol, max_flow, min_flow]]
+        self.policy = policy if policy is not None else ReleasePolicy()
+        self.policy.check(self)
+        self.release = np.full(ndam, np.nan)
+        self.t = 0
+        self.diagnostics = None
+
+    def step(self, inflow, rule_target):
+        ''' This function operates all reservoirs for one time step and updates storage
+
+        Input:
+            inflow: np.array of inflow to each reservoir of this time step [cfs]
+            rule_target: np.array of rule curve storage of each reservoir of this time step [ft3]
+
+        Return:
+            release: np.array of flow release of each reservoir of this time step [cfs]
+            storage: np.array of storage of each reservoir at the end of this time step [acre-feet]
+        '''
+
+        import numpy as np
+
+        inflow = np.asarray(inflow, dtype=float)
+        rule_target = np.asarray(rule_target, dtype=float)
+        # Release decided by the policy
+        final_release = self.policy.release(self, inflow, rule_target)  # [ft3/step]
+        # Update storage
+        S_prev = self.S
+        self.S = self.S + inflow*self.dt - final_release
+        self.release = final_release / self.dt  # convert to [cfs]
+        self.t += 1
+        # Accumulate diagnostics (see DIAGNOSTIC_NAMES); NaN (not operating) counts nothing
+        if self.diagnostics is not None:
+            diag = self.diagnostics
+            S = self.S
+            max_avail = S_prev + inflow*self.dt - self.bot_vol  # [ft3/step]
+            flood_cap = self.top_vol - rule_target  # [ft3]
+            diag[:, 0] += final_release <= self.min_flow*self.dt
+            diag[:, 1] += final_release >= self.max_flow*self.dt
+            diag[:, 2] += S < rule_target
+            diag[:, 3] += final_release >= max_avail
+            in_flood = S > rule_target
+            diag[:, 4] += in_flood
+            flood_use = np.zeros(len(S))
+            np.divide(S - rule_target, flood_cap, out=flood_use, where=in_flood & (flood_cap>0))
+            diag[:, 5] = np.fmax(diag[:, 5], flood_use)
+            diag[:, 6] = np.fmax(diag[:, 6], self.release - self.max_flow)
+
+        return self.release, self.S / 43560.0
+
+#====================================================================#
+#====================================================================#
+
+def check_operation_equivalence(top_vol, bot_vol, max_flow, min_flow, dt=86400.0, ntime=200):
+    ''' This function checks that the step-by-step states (ReservoirState, ReservoirStateBatch with the default policy) give the same release and storage as reservoir_operation_kernel (compiled and pure Python), on a synthetic series for each reservoir: rule curve swinging between the bottom and top volumn, and inflow from 0 to three times the maximum flow, so that minimum release, rule curve chase, maximum release and flood release all occur
+
+    Input:
+        top_vol, bot_vol: np.array of top and bottom volumn of each reservoir [ft3]
+        max_flow, min_flow: np.array of maximum and minimum allowed release of each reservoir [cfs]
+        dt: length of a time step [s] (86400 for daily)
+        ntime: number of time steps of the synthetic series
+
+    Raise:
+        ValueError if any release or storage differs
+
+    Require:
+        reservoir_operation_kernel
+        ReservoirState
+        ReservoirStateBatch
+    '''
+
+    import numpy as np
+
+    top_vol, bot_vol, max_flow, min_flow = [np.atleast_1d(np.asarray(x, dtype=float)) \
+                                            for x in [top_vol, bot_vol, max_flow, min_flow]]
+    ndam = len(top_vol)
+
+    #=== Synthetic series of each reservoir (reservoir, time) ===#
+    phase = 2 * np.pi * np.arange(ntime) / ntime
+    rule_curve = bot_vol[:, np.newaxis] + (top_vol - bot_vol)[:, np.newaxis] \
+                 * (0.5 + 0.4 * np.sin(phase))[np.newaxis, :]
+    random_state = np.random.RandomState(0)
+    inflow = 3 * max_flow[:, np.newaxis] * random_state.uniform(size=(ndam, ntime)) ** 3
+    init_S = rule_curve[:, 0]
+
+    #=== Vectorized state of all reservoirs ===#
+    state_batch = ReservoirStateBatch(init_S, top_vol, bot_vol, max_flow, min_flow, dt)
+    release_batch = np.empty((ndam, ntime))
+    storage_batch = np.empty((ndam, ntime))
+    for t in range(ntime):
+        release_batch[:, t], storage_batch[:, t] = state_batch.step(inflow[:, t], rule_curve[:, t])
+
+    for d in range(ndam):
+        state = ReservoirState(init_S[d], top_vol[d], bot_vol[d], max_flow[d], min_flow[d], dt)
+        steps = [state.step(inflow[d, t], rule_curve[d, t]) for t in range(ntime)]
+        results = [('ReservoirState', np.array([step[0] for step in steps]), \
+                    np.array([step[1] for step in steps])), \
+                   ('ReservoirStateBatch', release_batch[d], storage_batch[d])]
+        for use_jit in [True, False]:
+            release, storage = reservoir_operation_kernel(inflow[d], rule_curve[d], init_S[d], \
+                                        top_vol[d], bot_vol[d], max_flow[d], min_flow[d], \
+                                        use_jit=use_jit, dt=dt)
+            results.append(('reservoir_operation_kernel (use_jit={})'.format(use_jit), \
+                            release, storage))
+        name_0, release_0, storage_0 = results[0]
+        for name, release, storage in results[1:]:
+            if not (np.array_equal(release, release_0) and np.array_equal(storage, storage_0)):
+                raise ValueError('{} and {} give different release or storage for reservoir {}'.format(\
+                                                                        name, name_0, d))
+
+#====================================================================#
+#====================================================================#
+
+def calc_mass_balance_residual(inflow, outflow, storage_start, storage_end, dt=86400.0):
+    ''' This function calculates the mass-balance residual of a reservoir over a period from quantities saved independently of its operation: the inflow it received, the regulated flow at its cell in the output flow field (flow changes routed to the dam cell and added to the flow field, at output precision), and its output storage series
+
+    Input:
+        inflow: np.array of inflow to the reservoir at each time step of the period [cfs]
+        outflow: np.array of regulated flow at the dam cell at each time step of the period, as in the output flow field [cfs]
+        storage_start: storage before the period [acre-feet]
+        storage_end: storage at the end of the period, as in the output storage series [acre-feet]
+        dt: length of a time step [s]
+
+    Return:
+        inflow - outflow - storage change over the period [acre-feet]
+    '''
+
+    import numpy as np
+
+    inflow = np.asarray(inflow, dtype=float)
+    outflow = np.asarray(outflow, dtype=float)
+
+    return np.sum(inflow - outflow) * dt / 43560.0 - (storage_end - storage_start)
+
+#====================================================================#
+#====================================================================#
+
+def combine_diagnostics(diagnostics_1, diagnostics_2):
+    ''' This function combines operational diagnostics of two consecutive periods (e.g., time chunks): counts are summed, maxima are taken
+
+    Input:
+        diagnostics_1, diagnostics_2: np.array of diagnostics (..., len(DIAGNOSTIC_NAMES)) (see DIAGNOSTIC_NAMES)
 
+    Return:
+        np.array of combined diagnostics
+    '''
+
+    import numpy as np
+
+    diagnostics_1 = np.asarray(diagnostics_1, dtype=float)
+    diagnostics_2 = np.asarray(diagnostics_2, dtype=float)
+    combined = diagnostics_1 + diagnostics_2
+    for name in ['max_flood_capacity_use', 'max_spill_cfs']:
+        n = DIAGNOSTIC_NAMES.index(name)
+        combined[..., n] = np.fmax(diagnostics_1[..., n], diagnostics_2[..., n])
+
+    return combined
+
+#====================================================================#
+#====================================================================#
+
+def interp_rows(x, xp, fp):
+    ''' This function interpolates linearly on a separate table for each row of x, vectorized over the values of each row (a loop over rows only); x outside the table range is clamped to the end values
+
+    Input:
+        x: np.array of values to interpolate at; 1-D (n), or 2-D (n, m) with all m values of a row on the table of the row
+        xp: 2-D np.array of table x points of each row, non-decreasing along each row (n, npoint)
+        fp: 2-D np.array of table values at xp (n, npoint)
+
+    Return:
+        np.array of interpolated values, same shape as x; NaN where x is NaN or the table of the row is NaN
+    '''
+
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    x2 = x.reshape(len(x), -1)  # (n, m)
+    rows = np.arange(len(x))[:, np.newaxis]
+    # Segment of the table that x falls in; one binary search per row, so that no
+    # (n, npoint, m) temporary is needed (NaN sorts last, as NaN padding of a table)
+    j = np.empty(x2.shape, dtype=int)
+    for i in range(len(x2)):
+        j[i] = np.searchsorted(xp[i], x2[i], side='right') - 1
+    j = np.clip(j, 0, xp.shape[1] - 2)
+    x0, x1 = xp[rows, j], xp[rows, j+1]
+    f0, f1 = fp[rows, j], fp[rows, j+1]
+    # weight of the upper point (0 on flat segments, e.g. padding)
+    w = np.zeros(x2.shape)
+    np.divide(x2 - x0, x1 - x0, out=w, where=x1>x0)
+    w = np.where(np.isnan(x2) | np.isnan(x0), np.nan, np.clip(w, 0, 1))
+
+    return (f0 + w * (f1 - f0)).reshape(x.shape)
+
+#====================================================================#
+#====================================================================#
+
+class ReleasePolicy(object):
+    ''' Default operating policy: release to bring storage to the rule curve, no less than the minimum flow and no more than the maximum flow, unless the flood capacity above the rule curve is exceeded; the same release logic as reservoir_operation_kernel
+
+    A custom policy subclasses ReleasePolicy and overrides release(), written as array operations over the dams of the state (all dams and scenarios of a batch are decided together in one call per time step). Per-dam policy parameters are arrays with dams along the first axis, listed in dam_arrays so that select() can pick out a subset of dams
+
+    Attributes:
+        dam_arrays: names of the per-dam array attributes of the policy
+    '''
+
+    dam_arrays = ()
+
+    def release(self, state, inflow, rule_target):
+        ''' This function decides the release of all reservoirs of a state for one time step
+
+        Input:
+            state: ReservoirStateBatch before the time step (storage S [ft3], parameters, last release [cfs], time index t)
+            inflow: np.array of inflow to each reservoir of this time step [cfs]
+            rule_target: np.array of rule curve storage of each reservoir of this time step [ft3]
+
+        Return:
+            np.array of release of each reservoir of this time step [ft3/step]
+        '''
+
+        return self.rule_curve_release(state.S, inflow*state.dt, rule_target, state.top_vol, \
+                                       state.bot_vol, state.max_flow*state.dt, state.min_flow*state.dt)
+
+    def check(self, state):
+        ''' This function checks the policy parameters against the reservoirs of a state it is bound to (called by ReservoirStateBatch); the default policy has no parameters to check
+
+        Raise:
+            ValueError if a parameter is not valid for a reservoir
+        '''
+
+        pass
+
+    def select(self, index):
+        ''' This function returns the policy for a subset of the dams (index along the first axis of the per-dam arrays) '''
+
+        import copy
+        import numpy as np
+
+        policy = copy.copy(self)
+        for name in self.dam_arrays:
+            setattr(policy, name, np.asarray(getattr(self, name))[index])
+
+        return policy
+
+    @staticmethod
+    def rule_curve_release(S, inflow_vol, rule_target, top_vol, bot_vol, max_release, min_release):
+        ''' This function calculates the default release: rule curve chase with the minimum release floor, and the maximum release cap overridden by flood capacity
+
+        Input:
+            S: np.array of storage before the time step [ft3]
+            inflow_vol: np.array of inflow volumn of the time step [ft3/step]
+            rule_target: np.array of rule curve storage [ft3]
+            top_vol, bot_vol: np.array of top and bottom volumn [ft3]
+            max_release, min_release: np.array of maximum and minimum release volumn [ft3/step]
+
+        Return:
+            np.array of release [ft3/step]
+        '''
+
+        import numpy as np
+
+        # Maximum available water to release
+        max_avail = S + inflow_vol - bot_vol  # [ft3/step]
+        # Rease required to bring storage to rule curve
+        rule_req = np.maximum(0, S + inflow_vol - rule_target)  # [ft3/step]
+        # Additional flood max capacity
+        flood_cap = top_vol - rule_target  # [ft3]
+        # Step 1 - preliminary release
+        prelim_release = np.minimum(max_avail, np.maximum(rule_req, min_release))  # [ft3/step]
+        # Step 2 - final release (check flood)
+        reduced_release = np.maximum(max_release, prelim_release - flood_cap)  # [ft3/step]
+
+        return np.where(prelim_release <= max_release, prelim_release, reduced_release)
+
+#====================================================================#
+
+class StorageElevationArea(object):
+    ''' Storage-elevation-area tables of several dams packed into padded (dam, point) arrays, for looking up water level, surface area, head and hydropower of all dams at once with vectorized interpolation (see interp_rows)
+
+    Attributes:
+        storage: 2-D np.array of table storage of each dam (dam, point) [acre-feet]; NaN for a dam without table
+        elevation: 2-D np.array of water level at the table storage (dam, point) [ft]
+        area: 2-D np.array of surface area at the table storage (dam, point) [acres]
+        tailwater: np.array of tailwater elevation of each dam [ft]
+        max_turbine_flow: np.array of maximum flow through the turbines of each dam [cfs]; release above it is spilled
+        efficiency: np.array of turbine-generator efficiency of each dam (0-1)
+    '''
+
+    __slots__ = ('storage', 'elevation', 'area', 'tailwater', 'max_turbine_flow', 'efficiency')
+
+    def __init__(self, tables, tailwater=None, max_turbine_flow=None, efficiency=0.85):
+        ''' Input:
+            tables: list of table of each dam (see read_sea_table), None for a dam without table
+            tailwater: tailwater elevation of each dam [ft]; None (or NaN for a dam) for the lowest elevation of the table
+            max_turbine_flow: maximum turbine flow of each dam [cfs]; None (or NaN for a dam) for no limit
+            efficiency: turbine-generator efficiency (scalar or one for each dam)
+        '''
+
+        import numpy as np
+
+        ndam = len(tables)
+        npoint = max([len(table) for table in tables if table is not None] + [2])
+        self.storage, self.elevation, self.area = [np.full((ndam, npoint), np.nan) for n in range(3)]
+        for d, table in enumerate(tables):
+            if table is None:
+                continue
+            # Pad with the last point (flat segments)
+            table = np.concatenate([table, np.repeat(table[-1:], npoint-len(table), axis=0)])
+            self.storage[d], self.elevation[d], self.area[d] = table[:, 0], table[:, 1], table[:, 2]
+        self.tailwater = np.full(ndam, np.nan) if tailwater is None \
+                         else np.array(tailwater, dtype=float)
+        self.tailwater = np.where(np.isnan(self.tailwater), self.elevation[:, 0], self.tailwater)
+        self.max_turbine_flow = np.full(ndam, np.inf) if max_turbine_flow is None \
+                                else np.array(max_turbine_flow, dtype=float)
+        self.max_turbine_flow[np.isnan(self.max_turbine_flow)] = np.inf
+        self.efficiency = np.broadcast_to(np.asarray(efficiency, dtype=float), (ndam,)).copy()
+
+    def select(self, index):
+        ''' This function returns the tables of a subset of the dams (index may repeat dams, e.g. for several runs) '''
+
+        sea = StorageElevationArea.__new__(StorageElevationArea)
+        for name in self.__slots__:
+            setattr(sea, name, getattr(self, name)[index])
+
+        return sea
+
+    def evaluate(self, storage, release):
+        ''' This function looks up water level and surface area, and calculates head and hydropower of all dams
+
+        Input:
+            storage: np.array of reservoir storage of each dam [acre-feet]; 1-D (dam), or 2-D (dam, time)
+            release: np.array of release of each dam [cfs], same shape as storage
+
+        Return:
+            elevation: np.array of water level [ft]
+            area: np.array of surface area [acres]
+            head: np.array of head above tailwater [ft]
+            power: np.array of hydropower generated [MW]
+        '''
+
+        import numpy as np
+
+        storage = np.asarray(storage, dtype=float)
+        shape = (-1,) + (1,) * (storage.ndim - 1)  # broadcast per-dam values
+        elevation = interp_rows(storage, self.storage, self.elevation)
+        area = interp_rows(storage, self.storage, self.area)
+        head = np.maximum(0, elevation - self.tailwater.reshape(shape))
+        turbine_flow = np.minimum(release, self.max_turbine_flow.reshape(shape))  # [cfs]
+        # P = efficiency * rho * g * Q * H
+        power = self.efficiency.reshape(shape) * 1000.0 * 9.81 \
+                * (turbine_flow * pow(25.4*12/1000., 3)) * (head * 0.3048) / 1e6  # [MW]
+
+        return elevation, area, head, power
+
+#====================================================================#
+
+def read_sea_table(path):
+    ''' This function reads the storage-elevation-area table of a dam
+
+    Input:
+        path: table file path (<storage [acre-feet]> <elevation [ft]> <area [acres]>, with a header line; storage increasing)
+
+    Return:
+        2-D np.array of the table (point, 3)
+    '''
+
+    import numpy as np
+
+    table = np.atleast_2d(np.loadtxt(path, skiprows=1))
+    if table.shape[1]!=3 or len(table)<2 or np.any(np.diff(table[:, 0])<=0):
+        raise ValueError('{} needs at least 2 rows of storage, elevation and area, with storage increasing'.format(path))
+
+    return table
+
+#====================================================================#
+
+class HedgingPolicy(ReleasePolicy):
+    ''' Hedging rule: when water available (storage plus inflow) falls below a trigger volumn, the minimum release is cut back linearly, down to a fraction of it at the bottom volumn, to save water for later; otherwise the default policy
+
+    Attributes:
+        hedge_vol: np.array of trigger volumn of each dam [ft3]
+        hedge_factor: np.array of fraction of the minimum release kept at the bottom volumn of each dam (0-1)
+    '''
+
+    dam_arrays = ('hedge_vol', 'hedge_factor')
+
+    def __init__(self, hedge_vol, hedge_factor):
+        import numpy as np
+        self.hedge_vol = np.asarray(hedge_vol, dtype=float)
+        self.hedge_factor = np.asarray(hedge_factor, dtype=float)
+
+    def check(self, state):
+        import numpy as np
+        # the hedging fraction is scaled by hedge_vol - bot_vol
+        invalid = ~(np.broadcast_to(self.hedge_vol, state.bot_vol.shape) > state.bot_vol)
+        if invalid.any():
+            d = np.nonzero(invalid)[0][0]
+            raise ValueError('hedging trigger volumn must be above the bottom volumn; reservoir {} of '\
+                             'the policy has {} ft3 (bottom volumn {} ft3)'.format(\
+                             d, np.broadcast_to(self.hedge_vol, state.bot_vol.shape)[d], \
+                             state.bot_vol[d]))
+
+    def release(self, state, inflow, rule_target):
+        import numpy as np
+        avail = state.S + inflow*state.dt  # [ft3]
+        fraction = np.clip((avail - state.bot_vol) / (self.hedge_vol - state.bot_vol), 0, 1)
+        factor = self.hedge_factor + (1 - self.hedge_factor) * fraction
+        return self.rule_curve_release(state.S, inflow*state.dt, rule_target, state.top_vol, \
+                                       state.bot_vol, state.max_flow*state.dt, \
+                                       state.min_flow*state.dt*factor)
+
+#====================================================================#
+
+class PiecewisePolicy(ReleasePolicy):
+    ''' Storage-based release table: release is interpolated from a piecewise linear table of release vs. storage of each dam (see interp_rows), limited to the water available, and increased if needed to keep storage below the top volumn (the rule curve is not used)
+
+    Attributes:
+        storage_points: 2-D np.array of table storage of each dam, increasing along each row (dam, point) [ft3]
+        release_points: 2-D np.array of table release at storage_points (dam, point) [cfs]
+    '''
+
+    dam_arrays = ('storage_points', 'release_points')
+
+    def __init__(self, storage_points, release_points):
+        import numpy as np
+        self.storage_points = np.atleast_2d(np.asarray(storage_points, dtype=float))
+        self.release_points = np.atleast_2d(np.asarray(release_points, dtype=float))
+
+    def release(self, state, inflow, rule_target):
+        import numpy as np
+        inflow_vol = inflow*state.dt  # [ft3/step]
+        target = interp_rows(state.S, self.storage_points, self.release_points) * state.dt  # [ft3/step]
+        max_avail = state.S + inflow_vol - state.bot_vol  # [ft3/step]
+        flood_req = state.S + inflow_vol - state.top_vol  # [ft3/step]
+        return np.minimum(max_avail, np.maximum(target, flood_req))
+
+#====================================================================#
+
+class RampRatePolicy(ReleasePolicy):
+    ''' Ramp-rate limits: the release of another policy is limited to change by no more than a maximum increase or decrease from the release of the last time step, within the water available, unless storage would exceed the top volumn (no limit on the first time step of a state)
+
+    Attributes:
+        max_increase, max_decrease: np.array of maximum change of release per time step of each dam [cfs]
+        policy: the policy whose release is limited (default: ReleasePolicy())
+    '''
+
+    dam_arrays = ('max_increase', 'max_decrease')
+
+    def __init__(self, max_increase, max_decrease, policy=None):
+        import numpy as np
+        self.max_increase = np.asarray(max_increase, dtype=float)
+        self.max_decrease = np.asarray(max_decrease, dtype=float)
+        self.policy = policy if policy is not None else ReleasePolicy()
+
+    def check(self, state):
+        self.policy.check(state)
+
+    def release(self, state, inflow, rule_target):
+        import numpy as np
+        target = self.policy.release(state, inflow, rule_target)  # [ft3/step]
+        last = state.release * state.dt  # [ft3/step]
+        limited = np.minimum(np.maximum(target, last - self.max_decrease*state.dt), \
+                             last + self.max_increase*state.dt)
+        limited = np.where(np.isnan(last), target, limited)
+        max_avail = state.S + inflow*state.dt - state.bot_vol  # [ft3/step]
+        flood_req = state.S + inflow*state.dt - state.top_vol  # [ft3/step]
+        return np.minimum(max_avail, np.maximum(limited, flood_req))
+
+    def select(self, index):
+        policy = ReleasePolicy.select(self, index)
+        policy.policy = self.policy.select(index)
+        return policy
+
+#====================================================================#
+
+class SeasonalMinFlowPolicy(ReleasePolicy):
+    ''' Seasonal minimum flow: the default policy with a minimum release that varies over time (e.g., by month), in place of the constant minimum flow of each dam
+
+    Attributes:
+        min_flow: 2-D np.array of minimum release of each dam on each time step (dam, time) [cfs]; time index as the state's t
+    '''
+
+    dam_arrays = ('min_flow',)
+
+    def __init__(self, min_flow):
+        import numpy as np
+        self.min_flow = np.atleast_2d(np.asarray(min_flow, dtype=float))
+
+    def release(self, state, inflow, rule_target):
+        return self.rule_curve_release(state.S, inflow*state.dt, rule_target, state.top_vol, \
+                                       state.bot_vol, state.max_flow*state.dt, \
+                                       self.min_flow[:, state.t]*state.dt)
+
+#====================================================================#
+#====================================================================#
+
+def simulate_network_time_major(inflow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow, start_index, levels, link_from, link_to, link_lag, final_S=None, link_weight=None, dt=86400.0, policy=None, sea=None, hydro=None, diagnostics=None, init_release=None):
+    ''' This function simulates all reservoirs of a network together in one pass over time (time-major); at each time step, reservoirs are operated level by level from upstream to downstream, and the flow change (release - inflow) of each reservoir is sent to the reservoirs downstream through a ring buffer indexed by the lag [time steps]. Each reservoir follows the same release logic as reservoir_operation_kernel, or the operating policy if given
+
+    Input:
+        inflow: 2-D np.array of inflow to each reservoir without the flow changes from the reservoirs simulated here (reservoir, time) [cfs]
+        rule_curve: 2-D np.array of rule curve storage (reservoir, time) [ft3]
+        init_S, top_vol, bot_vol: 1-D np.array of initial, top and bottom storage of each reservoir [ft3]
+        max_flow, min_flow: 1-D np.array of maximum and minimum allowed release of each reservoir [cfs]
+        start_index: 1-D np.array of time index at which each reservoir starts operation (init_S is the storage at that time step)
+        levels: list of np.array of reservoir index, from upstream to downstream; reservoirs in one level must not be upstream of each other (see order_dams_topologically)
+        link_from, link_to, link_lag: 1-D np.array; flow change of reservoir link_from reaches reservoir link_to after link_lag time steps (one link for each reservoir downstream, not only the next one)
+        final_S: optional np.array; if given, filled in place with the storage of each reservoir at the end of the last time step [ft3]
+        link_weight: 1-D np.array of the fraction of flow change sent through each link (for travel-time kernels, see calc_lag_kernel); None for 1
+        dt: length of a time step [s] (86400 for daily)
+        policy: operating policy for all reservoirs (see ReleasePolicy; split by level with select()); None for the default release logic
+        sea, hydro: StorageElevationArea of all reservoirs and optional dict to fill with water level and hydropower (reservoir, time), as for reservoir_operation_kernel_batch
+        diagnostics: optional 2-D np.array (reservoir, len(DIAGNOSTIC_NAMES)); if given, filled in place with the operational diagnostics of each reservoir (see DIAGNOSTIC_NAMES)
+        init_release: 1-D np.array of release of each reservoir on the time step before the first one [cfs], as for reservoir_operation_kernel_batch; None for NaN (no earlier release)
+
+    Return:
+        release, storage: 2-D np.array of flow release [cfs] and reservoir storage [acre-feet] (reservoir, time); NaN before each reservoir starts operation
+        inflow_mod: 2-D np.array of inflow to each reservoir including the flow changes from upstream reservoirs (reservoir, time) [cfs]
+
+    Require:
+        ReservoirStateBatch
+        StorageElevationArea
+    '''
+
+    import numpy as np
+
+    inflow = np.asarray(inflow, dtype=float)
+    rule_curve = np.asarray(rule_curve, dtype=float)
+    nres, ntime = inflow.shape
+    use_sea = sea is not None and hydro is not None
+    init_S = np.asarray(init_S, dtype=float)
+    start_index = np.asarray(start_index, dtype=int)
+    link_from = np.asarray(link_from, dtype=int)
+    link_to = np.asarray(link_to, dtype=int)
+    link_lag = np.asarray(link_lag, dtype=int)
+    if link_weight is None:
+        link_weight = np.ones(len(link_lag))
+    link_weight = np.asarray(link_weight, dtype=float)
+
+    #=== Ring buffer of flow change arriving at each reservoir ===#
+    # slot t % nslot holds flow change arriving at time step t; a slot is cleared once
+    # read, and the longest lag never wraps onto a slot not read yet
+    nslot = link_lag.max() + 1 if len(link_lag)>0 else 1
+    ring = np.zeros((nres, nslot))
+
+    #=== Per level: state and links from the reservoirs of the level ===#
+    list_level = []
+    for level in levels:
+        level = np.asarray(level, dtype=int)
+        position = np.full(nres, -1)
+        position[level] = np.arange(len(level))
+        is_from = position[link_from] >= 0
+        state = ReservoirStateBatch(np.full(len(level), np.nan), top_vol[level], \
+                                    bot_vol[level], max_flow[level], min_flow[level], dt, \
+                                    policy.select(level) if policy is not None else None)
+        if init_release is not None:
+            state.release = np.asarray(init_release, dtype=float)[level]
+        state.diagnostics = np.zeros((len(level), len(DIAGNOSTIC_NAMES)))
+        list_level.append((level, state, position[link_from[is_from]], \
+                           link_to[is_from], link_lag[is_from], link_weight[is_from], \
+                           sea.select(level) if use_sea else None))
+
+    release = np.full((nres, ntime), np.nan)
+    storage = np.full((nres, ntime), np.nan)
+    inflow_mod = inflow.copy()
+    if use_sea:
+        for key in ['elevation', 'area', 'head', 'power']:
+            hydro[key] = np.full((nres, ntime), np.nan)
+
+    #=== Loop over each time step ===#
+    for t in range(ntime):
+        slot = t % nslot
+        for level, state, ind_from, ind_to, lag, weight, sea_level in list_level:
+            # Inflow including flow changes from upstream reservoirs arriving now
+            inflow_mod[level, t] += ring[level, slot]
+            ring[level, slot] = 0
+            # Set initial storage for reservoirs starting operation at this time step
+            started = start_index[level] <= t
+            state.S = np.where(start_index[level]==t, init_S[level], state.S)
+            state.t = t
+            release_t, storage_t = state.step(inflow_mod[level, t], rule_curve[level, t])
+            release[level, t] = np.where(started, release_t, np.nan)
+            storage[level, t] = np.where(started, storage_t, np.nan)
+            if use_sea:
+                hydro['elevation'][level, t], hydro['area'][level, t], hydro['head'][level, t], \
+                    hydro['power'][level, t] = sea_level.evaluate(storage[level, t], release[level, t])
+            # Send flow change downstream
+            if len(ind_to)>0:
+                dflow = np.where(started, release_t - inflow_mod[level, t], 0)
+                np.add.at(ring, (ind_to, (t+lag) % nslot), dflow[ind_from]*weight)
+
+    if final_S is not None:
+        for level, state, ind_from, ind_to, lag, weight, sea_level in list_level:
+            final_S[level] = np.where(start_index[level]<ntime, state.S, init_S[level])
+    if diagnostics is not None:
+        for level, state, ind_from, ind_to, lag, weight, sea_level in list_level:
+            diagnostics[level] = state.diagnostics
+
+    return release, storage, inflow_mod
+
+#====================================================================#
+#====================================================================#
+
+def simulate_gauge_flow(problem, candidates, networks=None):
+    ''' This function simulates flow at gauge cells for several candidate parameter sets together, all in memory (e.g., for calibration or sensitivity analysis): the dams of all candidates are simulated in one time-major pass (see simulate_network_time_major), and their flow changes are routed to the gauge cells
+
+    Input:
+        problem: dict of inputs prepared once (see setup_gauge_problem):
+            'inflow': 2-D np.array of natural inflow to each dam (dam, time) [cfs]
+            'rule_curve': 2-D np.array of rule curve of each dam (dam, time) [ft3]; NaN before operation
+            'start_index': np.array of time index at which each dam starts operation
+            'top_vol', 'bot_vol': np.array of top and bottom volumn of each dam [ft3]
+            'max_flow', 'min_flow': np.array of default maximum and minimum release of each dam [cfs]
+            'levels': list of np.array of dam index, from upstream to downstream (see order_dams_topologically)
+            'link_from', 'link_to', 'link_lag', 'link_weight', 'routing': flow change links between dams, and routing from dams to gauge cells (see compile_gauge_network)
+            'gauge_flow': 2-D np.array of natural flow at each gauge cell (gauge, time) [cfs]
+            'variables': list of (name, dam index) of each decision variable; name is 'max_flow', 'min_flow', 'top_vol' or 'bot_vol' (factor multiplied to the default), 'rule_curve_scale' (factor multiplied to the rule curve and initial storage) or 'rule_curve_offset' (added to the rule curve and initial storage, as a fraction of top_vol - bot_vol); other names (e.g., 'wave_velocity', see networks) are skipped
+            'dt': length of a time step [s]
+        candidates: 2-D np.array of decision variables of each candidate (candidate, variable)
+        networks: optional list of dicts of 'link_from', 'link_to', 'link_lag', 'link_weight' and 'routing' for each candidate (e.g., different wave velocity); None to use the ones in problem for all candidates
+
+    Return:
+        3-D np.array of flow at each gauge cell for each candidate (candidate, gauge, time) [cfs]
+
+    Require:
+        simulate_network_time_major
+        add_routed_delta
+    '''
+
+    import numpy as np
+
+    candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+    ncand = len(candidates)
+    ndam, ntime = problem['inflow'].shape
+    ngauge = len(problem['gauge_flow'])
+    if networks is None:
+        networks = [problem] * ncand
+
+    #=== Parameters of each dam of each candidate (candidate, dam) ===#
+    factor = dict((name, np.ones((ncand, ndam))) for name in \
+                  ['max_flow', 'min_flow', 'top_vol', 'bot_vol', 'rule_curve_scale'])
+    factor['rule_curve_offset'] = np.zeros((ncand, ndam))
+    for v, (name, i) in enumerate(problem['variables']):
+        if name in factor:
+            factor[name][:, i] = candidates[:, v]
+    top_vol = np.tile(problem['top_vol'], ncand) * factor['top_vol'].ravel()
+    bot_vol = np.tile(problem['bot_vol'], ncand) * factor['bot_vol'].ravel()
+
+    #=== Stack the dams of all candidates as one network of ncand*ndam reservoirs ===#
+    rule_curve = np.tile(problem['rule_curve'], (ncand, 1)) * factor['rule_curve_scale'].ravel()[:, np.newaxis] \
+                 + (factor['rule_curve_offset'].ravel() * (top_vol - bot_vol))[:, np.newaxis]
+    start_index = np.tile(problem['start_index'], ncand)
+    init_S = np.full(ncand*ndam, np.nan)
+    started = start_index<ntime
+    init_S[started] = rule_curve[started, start_index[started]]
+    link_from, link_to, link_lag, link_weight = \
+            [np.concatenate([np.asarray(network[key]) + (c*ndam if key in ['link_from', 'link_to'] else 0) \
+                             for c, network in enumerate(networks)]) \
+             for key in ['link_from', 'link_to', 'link_lag', 'link_weight']]
+    release, storage, inflow_mod = simulate_network_time_major(\
+                    np.tile(problem['inflow'], (ncand, 1)), rule_curve, init_S, top_vol, bot_vol, \
+                    np.tile(problem['max_flow'], ncand) * factor['max_flow'].ravel(), \
+                    np.tile(problem['min_flow'], ncand) * factor['min_flow'].ravel(), start_index, \
+                    [np.concatenate([np.asarray(level) + c*ndam for c in range(ncand)]) \
+                     for level in problem['levels']], \
+                    link_from.astype(int), link_to.astype(int), link_lag.astype(int), \
+                    link_weight=link_weight.astype(float), dt=problem['dt'])
+    dflow = np.where(np.isnan(release), 0, release - inflow_mod)  # 0 when not operating
+
+    #=== Route flow changes of each candidate to the gauge cells ===#
+    gauge_flow = np.empty((ncand, ngauge, ntime))
+    for c, network in enumerate(networks):
+        max_lag = max([lag for lag, gauges, matrix in network['routing']] + [0])
+        delta = np.zeros((ntime+max_lag, ngauge))
+        add_routed_delta(delta, network['routing'], 0, dflow[c*ndam:(c+1)*ndam])
+        gauge_flow[c] = problem['gauge_flow'] + delta[:ntime].T
+
+    return gauge_flow
+
+#====================================================================#
+#====================================================================#
+
+def compile_gauge_network(delta_store, list_kernel, downstream_dam, gauge_rows, gauge_cols):
+    ''' This function compiles the flow change links between dams and the routing from dams to a set of gauge cells, for in-memory simulation of gauge flow (see simulate_gauge_flow)
+
+    Input:
+        delta_store: sparse delta store (see init_sparse_delta)
+        list_kernel: list of (lag, weight) travel-time kernel of each dam (see calc_lag_kernel)
+        downstream_dam: np.array of the index of the immediate downstream dam of each dam; -1 if none (see find_downstream_dams)
+        gauge_rows, gauge_cols: index of the grid cell of each gauge
+
+    Return:
+        a dict of:
+            'link_from', 'link_to', 'link_lag', 'link_weight': np.array of dam-to-dam links, one for each kernel tap (see simulate_network_time_major)
+            'routing': list of (lag, gauges, scipy.sparse.csr_matrix (gauge, dam)) from dams to the gauge cells reached with each lag (see compile_routing_matrices); a gauge cell not downstream of any dam is not modified
+
+    Require:
+        compile_routing_matrices
+    '''
+
+    import numpy as np
+    import scipy.sparse
+
+    ndam = len(list_kernel)
+    #=== Dam-to-dam links (one for each kernel tap), for every dam downstream of each dam ===#
+    list_links = []
+    for i in range(ndam):
+        d = downstream_dam[i]
+        while d>=0:
+            j = np.where(delta_store['dam_cells'][i]==delta_store['dam_cells'][d][0])[0][0]
+            for lag, weight in zip(list_kernel[i][0][j], list_kernel[i][1][j]):
+                list_links.append((i, d, lag, weight))
+            d = downstream_dam[d]
+    network = {}
+    for n, key in enumerate(['link_from', 'link_to', 'link_lag']):
+        network[key] = np.array([link[n] for link in list_links], dtype=int)
+    network['link_weight'] = np.array([link[3] for link in list_links], dtype=float)
+
+    #=== Routing from dams to gauge cells ===#
+    gauge_cells = [delta_store['cell_index'].get((row, col), -1) for row, col in zip(gauge_rows, gauge_cols)]
+    ind_gauge = [g for g in range(len(gauge_cells)) if gauge_cells[g]>=0]
+    select_gauge = scipy.sparse.csr_matrix((np.ones(len(ind_gauge)), \
+                                            (ind_gauge, [gauge_cells[g] for g in ind_gauge])), \
+                                           shape=(len(gauge_cells), len(delta_store['rows'])))
+    network['routing'] = []
+    for lag, cells, matrix in compile_routing_matrices(delta_store, \
+                                    [kernel[0] for kernel in list_kernel], range(ndam), \
+                                    [kernel[1] for kernel in list_kernel]):
+        matrix = select_gauge[:, cells].dot(matrix).tocsr()
+        gauges = np.unique(matrix.nonzero()[0])  # gauges reached with this lag
+        if len(gauges)>0:
+            network['routing'].append((lag, gauges, matrix[gauges]))
+
+    return network
+
+#====================================================================#
+#====================================================================#
+
+def setup_gauge_problem(cfg, df_dam_info, gauge_lat, gauge_lon):
+    ''' This function prepares the in-memory problem of simulating flow at a set of gauge (or analyzed) cells (see simulate_gauge_flow), for a config file of reservoir_network.py with one RVIC output file: dams of df_dam_info, natural flow at the dam and gauge cells and rule curves over the [PARAM] period, and routing at the [NETWORK] wave velocity
+
+    Input:
+        cfg: config dict (see read_config), with the [NETWORK] lag options set (lag_method, diffusion, muskingum_x)
+        df_dam_info: pd.DataFrame of dam info (dam info csv)
+        gauge_lat, gauge_lon: np.array of lat and lon of each gauge cell
+
+    Return:
+        problem: dict of inputs of simulate_gauge_flow, except 'variables'
+        routing: dict of 'delta_store', 'downstream_dam', 'gauge_rows', 'gauge_cols', 'lag_method', 'diffusion', 'muskingum_x' and 'dt', to compile the routing at another wave velocity (see compile_gauge_routing)
+        dates: pd.DatetimeIndex of the time steps of the period
+
+    Raise:
+        ValueError if the RVIC output is an ensemble, a dam or gauge is outside the grid, the flow data do not cover whole days of the period, or the lag method cannot route the network (see calc_lag_kernel)
+
+    Require:
+        compile_routing_network
+        find_grid_index
+        find_downstream_dams
+        order_dams_topologically
+        init_sparse_delta
+        find_rvic_output_paths
+        calc_time_step
+        load_rule_curve_annual
+        expand_rule_curve
+        compile_gauge_routing
+    '''
+
+    import numpy as np
+    import xray
+    import datetime as dt
+    import pandas as pd
+    import os
+
+    ndam = len(df_dam_info)
+
+    #=== Period ===#
+    start_date_to_run = dt.datetime(cfg['PARAM']['start_date_to_run'][0], \
+                                    cfg['PARAM']['start_date_to_run'][1], \
+                                    cfg['PARAM']['start_date_to_run'][2], 12, 0)
+    end_date_to_run = dt.datetime(cfg['PARAM']['end_date_to_run'][0], \
+                                  cfg['PARAM']['end_date_to_run'][1], \
+                                  cfg['PARAM']['end_date_to_run'][2], 12, 0)
+
+    #=== Network, dam cells and gauge cells ===#
+    ds_network = xray.open_dataset(cfg['NETWORK']['route_nc'])
+    network = compile_routing_network(ds_network['Flow_Direction'], ds_network['Flow_Distance'])
+    dam_rows, dam_cols = zip(*[find_grid_index(network, lat, lon, cfg['NETWORK']['dlatlon']) \
+                               for lat, lon in zip(df_dam_info['grid_lat'].values, \
+                                                   df_dam_info['grid_lon'].values)])
+    gauge_rows, gauge_cols = zip(*[find_grid_index(network, lat, lon, cfg['NETWORK']['dlatlon']) \
+                                   for lat, lon in zip(gauge_lat, gauge_lon)])
+    downstream_dam = find_downstream_dams(network, dam_rows, dam_cols)
+    dam_order, dam_levels = order_dams_topologically(downstream_dam)
+    delta_store = init_sparse_delta(network, dam_rows, dam_cols, 0)
+
+    #=== Time steps of the period in the original flow data (RVIC grid format) ===#
+    if find_rvic_output_paths(cfg['INPUT']['rvic_output_path']) is not None:
+        raise ValueError('one RVIC output file is needed, not an ensemble')
+    ds_rvic = xray.open_dataset(cfg['INPUT']['rvic_output_path'])
+    flow_dates = pd.to_datetime(ds_rvic['time'].values)
+    dt_seconds = calc_time_step(flow_dates)
+    start_day = dt.datetime(start_date_to_run.year, start_date_to_run.month, start_date_to_run.day)
+    end_day = dt.datetime(end_date_to_run.year, end_date_to_run.month, end_date_to_run.day)
+    t_run_start = flow_dates.searchsorted(start_day)
+    t_run_end = flow_dates.searchsorted(end_day + dt.timedelta(days=1))  # exclusive
+    dates_to_run = flow_dates[t_run_start:t_run_end]
+    ntime = len(dates_to_run)
+    day_offset = np.asarray((dates_to_run.normalize() - start_day).days)
+    if ntime % int(86400/dt_seconds)!=0:
+        raise ValueError('RVIC output must cover whole days of the period')
+
+    #=== Natural flow at dam cells and gauge cells, in time chunks ===#
+    rows = np.array(list(dam_rows) + list(gauge_rows))
+    cols = np.array(list(dam_cols) + list(gauge_cols))
+    flow_cells = np.empty((ntime, len(rows)))
+    for t0 in range(0, ntime, 1000):
+        t1 = min(t0+1000, ntime)
+        flow_cells[t0:t1] = ds_rvic['streamflow'].isel(\
+                                time=slice(t_run_start+t0, t_run_start+t1)).values[:, rows, cols]
+    flow_cells *= pow(1000./25.4/12, 3)  # convert m3/s to cfs
+
+    #=== Rule curve of each dam on each time step [ft3] ===#
+    rule_curve = np.full((ndam, ntime), np.nan)
+    start_index = np.full(ndam, ntime, dtype=int)
+    for i in range(ndam):
+        dam_number = df_dam_info.ix[i]['dam_number']
+        dam_name = df_dam_info.ix[i]['dam_name']
+        rule_curve_annual = load_rule_curve_annual(\
+                                os.path.join(cfg['DAM_INFO']['rule_curve_dir'], \
+                                             'dam{}_{}.txt'.format(dam_number, dam_name.replace(' ', '_'))), \
+                                dam_number)
+        s_rule_curve = expand_rule_curve(rule_curve_annual, \
+                                         start_date_to_run, end_date_to_run) # [acre-feet]
+        year_operated = df_dam_info.ix[i]['year_operated_start_of_Calendar_year']
+        day_operated = max(0, (dt.datetime(year_operated, 1, 1) - start_day).days)
+        start_index[i] = day_offset.searchsorted(day_operated)
+        rule_curve[i, start_index[i]:] = s_rule_curve.values[day_offset[start_index[i]:]] * 43560.0
+
+    #=== Problem, with routing at the default wave velocity ===#
+    routing = {'delta_store': delta_store, 'downstream_dam': downstream_dam, \
+               'gauge_rows': gauge_rows, 'gauge_cols': gauge_cols, \
+               'lag_method': cfg['NETWORK']['lag_method'], 'diffusion': cfg['NETWORK']['diffusion'], \
+               'muskingum_x': cfg['NETWORK']['muskingum_x'], 'dt': dt_seconds}
+    problem = {'inflow': flow_cells[:, :ndam].T.copy(), 'rule_curve': rule_curve, \
+               'start_index': start_index, \
+               'top_vol': df_dam_info['top_vol_acre_feet'].values * 43560.0, \
+               'bot_vol': df_dam_info['bot_vol_acre_feet'].values * 43560.0, \
+               'max_flow': df_dam_info['max_flow_cfs'].values.astype(float), \
+               'min_flow': df_dam_info['min_flow_cfs'].values.astype(float), \
+               'levels': [np.array(level) for level in dam_levels], \
+               'gauge_flow': flow_cells[:, ndam:].T.copy(), 'dt': dt_seconds}
+    problem.update(compile_gauge_routing(routing, cfg['NETWORK']['wave_velocity']))
+
+    return problem, routing, dates_to_run
+
+#====================================================================#
+#====================================================================#
+
+def compile_gauge_routing(routing, velocity):
+    ''' This function compiles the flow change links between dams and the routing from dams to the gauge cells of a problem at a wave velocity (see setup_gauge_problem)
+
+    Input:
+        routing: dict of routing inputs (see setup_gauge_problem)
+        velocity: wave velocity [m/s]
+
+    Return:
+        a dict of 'link_from', 'link_to', 'link_lag', 'link_weight' and 'routing' (see compile_gauge_network)
+
+    Raise:
+        ValueError if the lag method cannot route the network (see calc_lag_kernel)
+
+    Require:
+        calc_lag_kernel
+        compile_gauge_network
+    '''
+
+    list_kernel = [calc_lag_kernel(flow_distance, velocity, method=routing['lag_method'], \
+                                   diffusion=routing['diffusion'], \
+                                   muskingum_x=routing['muskingum_x'], dt=routing['dt']) \
+                   for flow_distance in routing['delta_store']['dam_distance']]
+
+    return compile_gauge_network(routing['delta_store'], list_kernel, routing['downstream_dam'], \
+                                 routing['gauge_rows'], routing['gauge_cols'])
+
+#====================================================================#
+#====================================================================#
+
+def sample_sobol(nbase, nvar, random_state=None):
+    ''' This function generates samples for Sobol sensitivity indices (Saltelli scheme): two independent random matrices A and B, and for each variable i, A with column i taken from B
+
+    Input:
+        nbase: number of base samples (rows of A and B)
+        nvar: number of variables
+        random_state: np.random.RandomState; None for a new one
+
+    Return:
+        2-D np.array of samples in the unit hypercube (nbase*(nvar+2), nvar); rows are A, B, then A_B(i) for each variable i, nbase rows each (see calc_sobol_indices)
+    '''
+
+    import numpy as np
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+    A = random_state.uniform(size=(nbase, nvar))
+    B = random_state.uniform(size=(nbase, nvar))
+    list_samples = [A, B]
+    for i in range(nvar):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        list_samples.append(AB)
+
+    return np.concatenate(list_samples)
+
+#====================================================================#
+#====================================================================#
+
+def calc_sobol_indices(y, nvar):
+    ''' This function calculates first-order (Saltelli et al., 2010) and total (Jansen, 1999) Sobol indices from model outputs of samples from sample_sobol
+
+    Input:
+        y: np.array of model output of each sample (sample, ...), in the order of sample_sobol; any trailing dimensions are different outputs
+        nvar: number of variables
+
+    Return:
+        S1, ST: np.array of first-order and total index of each variable for each output (variable, ...); NaN for an output with no variance
+    '''
+
+    import numpy as np
+
+    y = np.asarray(y, dtype=float)
+    nbase = len(y) // (nvar + 2)
+    y = y.reshape((nvar + 2, nbase) + y.shape[1:])
+    # centered on the mean, so that outputs with a large mean and small variance stay accurate
+    y = y - np.mean(y[:2], axis=(0, 1))
+    yA, yB, yAB = y[0], y[1], y[2:]
+    var = np.var(np.concatenate([yA, yB]), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S1 = np.mean(yB * (yAB - yA), axis=1) / var
+        ST = 0.5 * np.mean((yA - yAB)**2, axis=1) / var
+    S1[..., var==0] = np.nan
+    ST[..., var==0] = np.nan
+
+    return S1, ST
+
+#====================================================================#
+#====================================================================#
+
+def sample_morris(ntraj, nvar, nlevel=4, random_state=None):
+    ''' This function generates Morris trajectories for elementary effect screening: each trajectory starts at a random point of a grid of nlevel levels, and changes one variable at a time (in random order) by delta = nlevel / (2 * (nlevel-1))
+
+    Input:
+        ntraj: number of trajectories
+        nvar: number of variables
+        nlevel: number of grid levels (even)
+        random_state: np.random.RandomState; None for a new one
+
+    Return:
+        2-D np.array of samples in the unit hypercube (ntraj*(nvar+1), nvar); nvar+1 rows for each trajectory (see calc_morris_indices)
+    '''
+
+    import numpy as np
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+    delta = nlevel / (2. * (nlevel - 1))
+    samples = np.empty((ntraj, nvar+1, nvar))
+    for r in range(ntraj):
+        x = random_state.randint(0, nlevel, nvar) / float(nlevel - 1)
+        samples[r, 0] = x
+        for n, i in enumerate(random_state.permutation(nvar)):
+            # step up if it stays in [0, 1], otherwise down
+            x[i] = x[i] + delta if x[i] + delta <= 1 else x[i] - delta
+            samples[r, n+1] = x
+
+    return samples.reshape(ntraj*(nvar+1), nvar)
+
+#====================================================================#
+#====================================================================#
+
+def calc_morris_indices(x, y, nvar):
+    ''' This function calculates Morris elementary effect statistics from model outputs of samples from sample_morris
+
+    Input:
+        x: 2-D np.array of samples in the unit hypercube (sample, variable), from sample_morris
+        y: np.array of model output of each sample (sample, ...); any trailing dimensions are different outputs
+        nvar: number of variables
+
+    Return:
+        mu, mu_star, sigma: np.array of mean, mean absolute and standard deviation of the elementary effects of each variable for each output (variable, ...); elementary effects are per unit change of the variable in the unit hypercube
+    '''
+
+    import numpy as np
+
+    y = np.asarray(y, dtype=float)
+    ntraj = len(y) // (nvar + 1)
+    x = np.asarray(x, dtype=float).reshape(ntraj, nvar+1, nvar)
+    y = y.reshape((ntraj, nvar+1) + y.shape[1:])
+    effects = np.empty((nvar, ntraj) + y.shape[2:])
+    for r in range(ntraj):
+        dx = np.diff(x[r], axis=0)
+        for n in range(nvar):
+            i = np.argmax(np.abs(dx[n]))
+            effects[i, r] = (y[r, n+1] - y[r, n]) / dx[n, i]
+
+    return effects.mean(axis=1), np.abs(effects).mean(axis=1), effects.std(axis=1)
+
+#====================================================================#
+#====================================================================#
+
+def find_downstream_grid(da_flowdir, lat, lon, dlatlon):
+    ''' This function finds the immediate downstream grid cell based on 1-8 formatted flow direction
+    Input:
+        da_flowdir: xray.DataArray of flow direction file (1-8 format)
+        lat, lon: lat and lon of the current grid cell
+        dlatlon: delta lat and lon (e.g., 0.125)
+
+    Return:
+        lat, lon: lat lon of the immediate downstream grid cell
+                  (if the current grid cell is an outlet, return -999, -999)
+
+    '''
+
+    import numpy as np
+
+    #=== Extract flow direction of the current grid cell ===#
+    flowdir = int(da_flowdir.loc[lat, lon].values)
+
+    #=== Identify the next grid cell ===#
+    lat_next, lon_next = lat, lon  # initialize
+    if flowdir not in [1,2,3,4,5,6,7,8]:  # if don't have valid direction, then it's an outlet
+        return -999, -999
+    else:
+        # Process lat
+        if flowdir in [1,2,8]:
+            lat_next = lat + dlatlon
+        elif flowdir in [4,5,6]:
+            lat_next = lat - dlatlon
+        # Process lon
+        if flowdir in [2,3,4]:
+            lon_next = lon + dlatlon
+        elif flowdir in [6,7,8]:
+            lon_next = lon - dlatlon
+
+    #=== Check if the next grid cell is still within basin ===#
+    if da_flowdir.loc[lat_next,lon_next].values not in [1,2,3,4,5,6,7,8]:  
+    # if the next cell outside of basin
+        return -999, -999
+    else:  # if the next cell still within the basin
+        return lat_next, lon_next
+
+#====================================================================#
+#====================================================================#
+
+def modify_flow_all_downstream_cell(lat, lon, orig_flow, release, da_flow, dlatlon, da_flowdir, da_flowdis, velocity):
+    ''' This function modifies flow at all downstream cells from an operated dam
+
+    Input:
+        lat, lon: lat and lon of the dam
+        orig_flow: pd.Series of original inflow at the dam [cfs]
+        release: pd.Series of simulated release at the dam [cfs]; only for period with operation
+        da_flow: xray.DataArray of original streamflow field (time, lat, lon)
+        dlatlon: delta lat and lon (e.g., 0.125)
+        da_flowdir: xray.DataArray of flow direction file (1-8 format)
+        da_flowdis: xray.DataArray of flow distance file [m]
+        velocity: wave velocity [m/s]
+
+    Return: xray.DataArray of modified streamflow field after this dam is operated
+            (time, lat, lon)
+
+    Require:
+        find_downstream_grid(da_flowdir, lat, lon, dlatlon)
+
+    '''
+
+    import pandas as pd
+    import datetime as dt
+
+    #=== Find period with reservoir operation ===#
+    start_date_to_run = release.index[0]
+    end_date_to_run = release.index[-1]
+
+    #=== Calculate delta flow ===#
+    s_dflow = release - orig_flow[pd.date_range(start_date_to_run, end_date_to_run)]
+
+    #=== Modify flow at the first grid cell (i.e., the dam grid cell) ===#
+    da_flow.loc[pd.date_range(start_date_to_run, end_date_to_run),lat,lon] = release
+
+    #=== Initialize flow distance from the dam to the current downstream grid cell [m] ===#
+    fdis = 0
+
+    #=== Move to the immediate downstream grid cell ===#
+    lat_current, lon_current = find_downstream_grid(da_flowdir, lat, lon, dlatlon)
+    if lat_current==-999 and lon_current==-999:
+    # if the immediate downstream grid cell is outside of the basin, 
+    # done with all modification for this dam
+        return da_flow
+
+    #=== Loop over each downstream grid cell, and modify flow ===#
+    while 1:
+        #=== Identify time lag (to flow from dam to the current grid cell) ===#
+        fdis = fdis + da_flowdis.loc[lat_current, lon_current]
+        lag_days = int(round(fdis / velocity / 86400.0))  # [day], precise to integer days
+        #=== Modify flow for the current grid cell ===#
+        # Identify lagged time range
+        start_date_lagged = start_date_to_run + dt.timedelta(days=lag_days)
+        end_date_lagged = end_date_to_run + dt.timedelta(days=lag_days)
+        # Modify flow for this grid cell
+        if (end_date_lagged-orig_flow.index[-1]).days <= 0: # if within orig_flow time range
+            da_flow.loc[pd.date_range(start_date_lagged, end_date_lagged),lat_current,lon_current] \
+                    += s_dflow.values
+        else:   # if later than orig_flow time range
+            days_to_modify = (orig_flow.index[-1] - start_date_lagged).days + 1
+            da_flow.loc[pd.date_range(start_date_lagged, orig_flow.index[-1]),\
+                                      lat_current,lon_current] \
+                    += s_dflow.values[0:days_to_modify]
+        #=== Move to the next downstream grid cell ===#
+        lat_current, lon_current = find_downstream_grid(da_flowdir, \
+                                        lat_current, lon_current, dlatlon)
+        if lat_current==-999 and lon_current==-999:
+        # if the immediate downstream grid cell is outside of the basin, 
+        # done with all modification for this dam
+            break
+    return da_flow
+
+#====================================================================#
+#====================================================================#
+
+def compile_routing_network(da_flowdir, da_flowdis):
+    ''' This function compiles the RVIC routing network into integer grid indices, so that downstream walks become array indexing instead of repeated lat/lon label lookups
+
+    Input:
+        da_flowdir: xray.DataArray of flow direction file (1-8 format) (lat, lon)
+        da_flowdis: xray.DataArray of flow distance file [m] (lat, lon)
+
+    Return:
+        a dict of the compiled network:
+            'lat', 'lon': np.array of grid lat and lon
+            'downstream_row', 'downstream_col': 2-D np.array (lat, lon) of the (row, col) index of the immediate downstream grid cell of each cell; -1 if the cell is an outlet or the next cell is outside of the basin
+            'flow_distance': 2-D np.array (lat, lon) of flow distance [m]
+    '''
+
+    import numpy as np
+
+    lat = da_flowdir['lat'].values
+    lon = da_flowdir['lon'].values
+    flowdir = da_flowdir.values
+    nlat, nlon = flowdir.shape
+
+    #=== Identify cells with valid flow direction (within basin) ===#
+    valid = np.isin(flowdir, [1,2,3,4,5,6,7,8])
+
+    #=== Step in lat and lon for each direction (same convention as find_downstream_grid) ===#
+    dlat_step = np.zeros(flowdir.shape, dtype=int)
+    dlat_step[np.isin(flowdir, [1,2,8])] = 1
+    dlat_step[np.isin(flowdir, [4,5,6])] = -1
+    dlon_step = np.zeros(flowdir.shape, dtype=int)
+    dlon_step[np.isin(flowdir, [2,3,4])] = 1
+    dlon_step[np.isin(flowdir, [6,7,8])] = -1
+    # Convert coordinate steps to index steps (lat or lon may be in decreasing order)
+    lat_sign = 1 if (nlat<2 or lat[-1]>lat[0]) else -1
+    lon_sign = 1 if (nlon<2 or lon[-1]>lon[0]) else -1
+
+    #=== Locate the immediate downstream cell ===#
+    row, col = np.meshgrid(np.arange(nlat), np.arange(nlon), indexing='ij')
+    row_next = row + dlat_step * lat_sign
+    col_next = col + dlon_step * lon_sign
+    in_grid = (row_next>=0) & (row_next<nlat) & (col_next>=0) & (col_next<nlon)
+    has_next = valid & in_grid
+    # the next cell must still be within the basin
+    has_next[has_next] = valid[row_next[has_next], col_next[has_next]]
+    downstream_row = np.where(has_next, row_next, -1)
+    downstream_col = np.where(has_next, col_next, -1)
+
+    return {'lat': lat, 'lon': lon, \
+            'downstream_row': downstream_row, 'downstream_col': downstream_col, \
+            'flow_distance': da_flowdis.values}
+
+#====================================================================#
+#====================================================================#
+
+def find_grid_index(network, lat, lon, dlatlon):
+    ''' This function finds the (row, col) index of the grid cell containing a lat lon location
+
+    Input:
+        network: compiled network (see compile_routing_network)
+        lat, lon: lat and lon of the location
+        dlatlon: delta lat and lon (e.g., 0.125)
+
+    Return:
+        row, col: index of the grid cell in the network grid
+
+    Raise:
+        ValueError if the location is more than half a grid cell from the nearest cell center (outside of the routing grid)
+    '''
+
+    import numpy as np
+
+    row = int(np.abs(network['lat'] - lat).argmin())
+    col = int(np.abs(network['lon'] - lon).argmin())
+    if abs(network['lat'][row] - lat) > dlatlon/2.0 or abs(network['lon'][col] - lon) > dlatlon/2.0:
+        raise ValueError('lat {} lon {} is outside of the routing grid'.format(lat, lon))
+
+    return row, col
+
+#====================================================================#
+#====================================================================#
+
+def find_downstream_path(network, row, col):
+    ''' This function finds all downstream grid cells of a grid cell (e.g., a dam) from the compiled network
+
+    Input:
+        network: compiled network (see compile_routing_network)
+        row, col: index of the starting grid cell
+
+    Return:
+        path_rows, path_cols: np.array of index of downstream grid cells, from upstream to downstream (not including the starting cell)
+        path_distance: np.array of cumulative flow distance from the starting cell to each downstream cell [m]
+    '''
+
+    import numpy as np
+
+    downstream_row = network['downstream_row']
+    downstream_col = network['downstream_col']
+    max_len = downstream_row.size  # guard against loops in a corrupted flow direction file
+
+    path_rows = []
+    path_cols = []
+    r, c = downstream_row[row, col], downstream_col[row, col]
+    while r!=-1 and len(path_rows)<max_len:
+        path_rows.append(r)
+        path_cols.append(c)
+        r, c = downstream_row[r, c], downstream_col[r, c]
+    path_rows = np.array(path_rows, dtype=int)
+    path_cols = np.array(path_cols, dtype=int)
+
+    path_distance = np.cumsum(network['flow_distance'][path_rows, path_cols])
+
+    return path_rows, path_cols, path_distance
+
+#====================================================================#
+#====================================================================#
+
+def calc_time_step(time):
+    ''' This function calculates the length of the model time step from the time coordinate of the flow data
+
+    Input:
+        time: pd.DatetimeIndex of the flow data (e.g., daily or sub-daily RVIC output)
+
+    Return:
+        dt: length of a time step [s]; 86400 if there is only one time step
+    '''
+
+    import numpy as np
+
+    if len(time)<2:
+        return 86400.0
+    steps = np.diff(time.values).astype('timedelta64[s]').astype(float)
+    if np.any(steps!=steps[0]) or steps[0]<=0:
+        raise ValueError('time steps of the flow data are not uniform')
+
+    return float(steps[0])
+
+#====================================================================#
+
+def calc_lag_days(flow_distance, velocity, dt=86400.0):
+    ''' This function calculates flow time lag from flow distance, rounded to integer time steps (days for daily)
+
+    Input:
+        flow_distance: np.array of flow distance [m]
+        velocity: wave velocity [m/s]
+        dt: length of a time step [s]
+
+    Return:
+        np.array of time lag [time step] (int)
+    '''
+
+    import numpy as np
+
+    lag = np.asarray(flow_distance / velocity / dt, dtype=float)
+    return np.floor(lag + 0.5).astype(int)  # round half away from zero (lag>=0)
+
+#====================================================================#
+#====================================================================#
+
+def calc_lag_kernel(flow_distance, velocity, method='round', diffusion=None, muskingum_x=None, dt=86400.0):
+    ''' This function calculates the travel-time kernel from flow distance: flow change at the dam reaches each cell spread over one or more lags of whole time steps (days for daily), with weights summing to 1
+
+    Input:
+        flow_distance: np.array of flow distance to each cell [m] (for 'muskingum', cells in the order of the downstream path, starting from the dam cell)
+        velocity: wave velocity [m/s]
+        method: 'round' - travel time rounded to whole time steps (one lag, weight 1; see calc_lag_days);
+                'linear' - travel time split linearly between the two adjacent whole time steps;
+                'diffusion' - impulse response of the linearized Saint-Venant (advection-diffusion) equation, as used for the RVIC unit hydrograph, aggregated to whole time steps (step n covers travel times in [n-0.5, n+0.5) steps, as 'round' does)
+                'muskingum': Muskingum routing through each reach of the path (see calc_muskingum_kernel)
+        diffusion: diffusion coefficient [m2/s]; for 'diffusion' only
+        muskingum_x: Muskingum weighting factor X (0-0.5); for 'muskingum' only
+        dt: length of a time step [s]
+
+    Return:
+        lag_days: 2-D np.array of time lag of each kernel tap (cell, tap) [time step] (int)
+        weights: 2-D np.array of weight of each kernel tap (cell, tap)
+    '''
+
+    import numpy as np
+
+    flow_distance = np.asarray(flow_distance, dtype=float)
+    ncell = len(flow_distance)
+
+    if method=='round':
+        lag_days = calc_lag_days(flow_distance, velocity, dt)[:, np.newaxis]
+        weights = np.ones((ncell, 1))
+    elif method=='linear':
+        lag = flow_distance / velocity / dt
+        lag_floor = np.floor(lag)
+        lag_days = np.column_stack([lag_floor, lag_floor+1]).astype(int)
+        weights = np.column_stack([1 - (lag - lag_floor), lag - lag_floor])
+    elif method=='diffusion':
+        if diffusion is None:
+            raise ValueError('diffusion coefficient is needed for diffusion routing')
+        #=== Impulse response on 24 sub-steps per step, up to the longest travel time plus 6 spreads ===#
+        nsub = 24
+        x_max = flow_distance.max() if ncell>0 else 0
+        t_max = x_max / velocity + 6 * np.sqrt(2 * diffusion * x_max / velocity**3)  # [s]
+        nday = int(np.ceil(t_max / dt)) + 2
+        t = (np.arange(nday*nsub) + 0.5) / nsub - 0.5  # [step]; step n covers [n-0.5, n+0.5)
+        t_sec = np.maximum(t, 0.5/nsub) * dt  # [s]
+        x = flow_distance[:, np.newaxis]
+        h = x / (2 * t_sec * np.sqrt(np.pi * t_sec * diffusion)) \
+            * np.exp(-(velocity*t_sec - x)**2 / (4 * diffusion * t_sec))
+        h[:, t<0] = 0
+        weights = h.reshape(ncell, nday, nsub).sum(axis=2)
+        # The dam cell itself (no distance) has no delay
+        weights[flow_distance==0] = 0
+        weights[flow_distance==0, 0] = 1
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+        #=== Drop negligible taps at the end ===#
+        weights[weights<1e-6] = 0
+        ntap = np.nonzero(weights.any(axis=0))[0].max() + 1 if ncell>0 else 1
+        weights = weights[:, :ntap] / weights[:, :ntap].sum(axis=1)[:, np.newaxis]
+        lag_days = np.broadcast_to(np.arange(ntap), (ncell, ntap)).copy()
+    elif method=='muskingum':
+        if muskingum_x is None:
+            raise ValueError('Muskingum X is needed for Muskingum routing')
+        lag_days, weights = calc_muskingum_kernel(flow_distance, velocity, muskingum_x, dt)
+    else:
+        raise ValueError('unsupported lag method: {}'.format(method))
+
+    return lag_days, weights
+
+#====================================================================#
+#====================================================================#
+
+def find_downstream_dams(network, dam_rows, dam_cols):
+    ''' This function finds, for each dam, the next modeled dam on its downstream path
+
+    Input:
+        network: compiled network (see compile_routing_network)
+        dam_rows, dam_cols: index of the grid cell of each dam
+
+    Return:
+        np.array of the index (position in dam_rows/dam_cols) of the immediate downstream dam of each dam; -1 if no modeled dam downstream
+        (if several dams are in the same grid cell, they are chained in list order)
+
+    Require:
+        find_downstream_path
+    '''
+
+    import numpy as np
+
+    ndam = len(dam_rows)
+    downstream_dam = np.full(ndam, -1, dtype=int)
+
+    #=== Map grid cell to dams in it ===#
+    dict_cell_dams = {}
+    for i in range(ndam):
+        dict_cell_dams.setdefault((dam_rows[i], dam_cols[i]), []).append(i)
+
+    for i in range(ndam):
+        #=== Another dam later in the list in the same grid cell ===#
+        same_cell = dict_cell_dams[(dam_rows[i], dam_cols[i])]
+        pos = same_cell.index(i)
+        if pos < len(same_cell) - 1:
+            downstream_dam[i] = same_cell[pos+1]
+            continue
+        #=== Otherwise, the first dam met along the downstream path ===#
+        path_rows, path_cols, path_distance = find_downstream_path(\
+                                                network, dam_rows[i], dam_cols[i])
+        for r, c in zip(path_rows, path_cols):
+            if (r, c) in dict_cell_dams:
+                downstream_dam[i] = dict_cell_dams[(r, c)][0]
+                break
+
+    return downstream_dam
+
+#====================================================================#
+#====================================================================#
+
+def order_dams_topologically(downstream_dam):
+    ''' This function orders dams from upstream to downstream (topological order of the dam network), and groups them into independent levels
+
+    Input:
+        downstream_dam: np.array of the index of the immediate downstream dam of each dam; -1 if none (see find_downstream_dams)
+
+    Return:
+        order: list of dam indices from upstream to downstream
+        levels: list of levels; each level is a list of dam indices. Level 0 has no modeled dam upstream; a dam in level n has its longest chain of upstream dams n long. Dams within a level do not depend on each other and can be simulated together, once all previous levels are done
+    '''
+
+    import numpy as np
+
+    downstream_dam = np.asarray(downstream_dam, dtype=int)
+    ndam = len(downstream_dam)
+
+    #=== Count immediate upstream dams of each dam ===#
+    n_upstream = np.zeros(ndam, dtype=int)
+    for j in downstream_dam[downstream_dam>=0]:
+        n_upstream[j] += 1
+
+    #=== Peel off dams with no remaining upstream dam, one level at a time (Kahn) ===#
+    order = []
+    levels = []
+    current = [i for i in range(ndam) if n_upstream[i]==0]
+    while len(current) > 0:
+        levels.append(current)
+        order.extend(current)
+        next_level = []
+        for i in current:
+            j = downstream_dam[i]
+            if j >= 0:
+                n_upstream[j] -= 1
+                if n_upstream[j] == 0:
+                    next_level.append(j)
+        current = sorted(next_level)
+
+    if len(order) < ndam:
+        raise ValueError('Dam network has a loop; check flow direction file')
+
+    return order, levels
+
+#====================================================================#
+#====================================================================#
+
+def init_sparse_delta(network, dam_rows, dam_cols, ntime):
+    ''' This function initializes a sparse store of flow changes caused by dam operation; only grid cells that can be modified (dam cells and their downstream cells) are kept
+
+    Input:
+        network: compiled network (see compile_routing_network)
+        dam_rows, dam_cols: index of the grid cell of each dam
+        ntime: number of time steps of the delta buffer (e.g., the whole flow field; or a chunk plus the maximum lag when streaming over time chunks)
+
+    Return:
+        a dict of the sparse delta store:
+            'rows', 'cols': np.array of grid index of each modified cell
+            'cell_index': dict of (row, col) -> position of the cell in 'rows'/'cols'
+            'dam_cells', 'dam_distance': list of np.array for each dam; positions (in 'rows'/'cols') of the dam cell followed by all its downstream cells, and flow distance to each of them [m] (0 for the dam cell)
+            'delta': 2-D np.array (time, modified cell) of accumulated flow change [cfs]; may be replaced by the caller, e.g., for each time chunk
+
+    Require:
+        find_downstream_path
+    '''
+
+    import numpy as np
+
+    dict_cell_index = {}
+    list_dam_cells = []
+    list_dam_distance = []
+    for row, col in zip(dam_rows, dam_cols):
+        path_rows, path_cols, path_distance = find_downstream_path(network, row, col)
+        cells = []
+        for r, c in zip(np.append(row, path_rows), np.append(col, path_cols)):
+            if (r, c) not in dict_cell_index:
+                dict_cell_index[(r, c)] = len(dict_cell_index)
+            cells.append(dict_cell_index[(r, c)])
+        list_dam_cells.append(np.array(cells, dtype=int))
+        list_dam_distance.append(np.append(np.zeros(1, dtype=path_distance.dtype), path_distance))
+
+    rows = np.empty(len(dict_cell_index), dtype=int)
+    cols = np.empty(len(dict_cell_index), dtype=int)
+    for (r, c), k in dict_cell_index.items():
+        rows[k] = r
+        cols[k] = c
+
+    return {'rows': rows, 'cols': cols, 'cell_index': dict_cell_index, \
+            'dam_cells': list_dam_cells, 'dam_distance': list_dam_distance, \
+            'delta': np.zeros((ntime, len(rows)))}
+
+#====================================================================#
+#====================================================================#
+
+def calc_muskingum_kernel(flow_distance, velocity, muskingum_x, dt=86400.0):
+    ''' This function calculates the travel-time kernel of flow change from a dam to each cell of its downstream path, routed by Muskingum through the reaches of the path; flow change is attenuated as well as delayed
+
+    The Muskingum recursion O[n+1] = C0*I[n+1] + C1*I[n] + C2*O[n] of each reach is linear, so the recursions of all reaches along the path are evaluated together as a product of the reach transfer functions (C0 + C1*z^-1) / (1 - C2*z^-1) - a cumulative product along the path gives every cell at once, and no loop over time is needed. To keep all coefficients non-negative with the model time step, every routed (sub-)reach must have dt/(2(1-X)) <= K <= dt/(2X): short reaches are lumped with the next ones until K >= dt/(2(1-X)) (cells inside a lump get the flow of the previous routed cell), and long reaches are split into the fewest equal sub-reaches with K <= dt/(2X); for X > 1/3 this can leave sub-reaches shorter than dt/(2(1-X)), in which case no valid split exists
+
+    Input:
+        flow_distance: np.array of flow distance from the dam to the dam cell and each downstream cell, in the order of the path (starting with 0) [m]
+        velocity: wave velocity [m/s]; travel time K of a reach is its length / velocity
+        muskingum_x: Muskingum weighting factor X (0-0.5)
+        dt: length of a time step [s]
+
+    Return:
+        lag_days: 2-D np.array of time lag of each kernel tap (cell, tap) [time step] (int)
+        weights: 2-D np.array of weight of each kernel tap (cell, tap)
+
+    Raise:
+        ValueError if a reach cannot be split into sub-reaches with non-negative coefficients (reduce X)
+    '''
+
+    import numpy as np
+
+    flow_distance = np.asarray(flow_distance, dtype=float)
+    ncell = len(flow_distance)
+
+    #=== Travel time of each routed reach ===#
+    K_cell = np.diff(flow_distance, prepend=flow_distance[:1]) / velocity  # [s]
+    K = np.zeros(ncell)  # 0 for cells inside a lump (not routed)
+    K_lump = 0
+    for j in range(ncell):
+        K_lump += K_cell[j]
+        if K_lump >= dt / (2 * (1 - muskingum_x)):
+            K[j] = K_lump
+            K_lump = 0
+    # fewest sub-reaches with K <= dt/(2X); they must still have K >= dt/(2(1-X))
+    nsplit = np.maximum(1, np.ceil(2 * K * muskingum_x / dt - 1e-9))
+    invalid = (K > 0) & (nsplit > 2 * K * (1 - muskingum_x) / dt + 1e-9)
+    if invalid.any():
+        raise ValueError('Muskingum X = {} gives negative coefficients for a reach of travel time {:.3f} '\
+                         'time steps; no sub-reach split keeps dt/(2(1-X)) <= K <= dt/(2X)'.format(\
+                         muskingum_x, K[invalid][0] / dt))
+    nsplit = nsplit[:, np.newaxis]
+    K = (K / nsplit[:, 0])[:, np.newaxis]
+
+    #=== Transfer function of each reach on the frequency grid ===#
+    # long enough that the response of the whole path dies out (no wrap-around)
+    t_total = flow_distance[-1] / velocity if ncell>0 else 0  # [s]
+    nday = int(np.ceil(6 * t_total / dt)) + 4
+    z1 = np.exp(-2j * np.pi * np.fft.rfftfreq(2*nday))[np.newaxis, :]  # z^-1
+    denom = 2 * K * (1 - muskingum_x) + dt
+    C0 = (dt - 2 * K * muskingum_x) / denom
+    C1 = (dt + 2 * K * muskingum_x) / denom
+    C2 = (2 * K * (1 - muskingum_x) - dt) / denom
+    H = ((C0 + C1*z1) / (1 - C2*z1)) ** nsplit
+    H[K[:, 0]==0] = 1  # not routed (e.g., the dam cell itself)
+
+    #=== Impulse response of each cell ===#
+    weights = np.fft.irfft(np.cumprod(H, axis=0), n=2*nday, axis=1)[:, :nday]
+
+    #=== Drop negligible taps ===#
+    # all coefficients are non-negative, so any negative tap is FFT round-off
+    weights[np.abs(weights)<1e-6] = 0
+    ntap = np.nonzero(weights.any(axis=0))[0].max() + 1 if ncell>0 else 1
+    weights = weights[:, :ntap] / weights[:, :ntap].sum(axis=1)[:, np.newaxis]
+    lag_days = np.broadcast_to(np.arange(ntap), (ncell, ntap)).copy()
+
+    return lag_days, weights
+
+#====================================================================#
+#====================================================================#
+
+def compile_routing_matrices(delta_store, list_lag_days, dams, list_lag_weights=None):
+    ''' This function compiles the downstream routing of a set of dams into one sparse (cell x dam) matrix for each distinct lag, over only the cells reached with that lag, so that flow changes of all the dams are routed to all their downstream cells with a few sparse matrix products (see add_routed_delta)
+
+    Input:
+        delta_store: sparse delta store (see init_sparse_delta)
+        list_lag_days: list of np.array of time lag from each dam (in the order of the store) to its dam cell and each downstream cell [time step]; 1-D (cell), or 2-D (cell, kernel tap) (see calc_lag_kernel)
+        dams: list of index of the dams to compile (columns of the matrices, in this order)
+        list_lag_weights: list of np.array of weight of each lag, same shape as list_lag_days; None for weight 1
+
+    Return:
+        list of (lag, cells, scipy.sparse.csr_matrix (cell, dam)); cells is np.array of the positions (in the store) of the modified cells reached with that lag, one for each row of the matrix; element is the weight with which flow change of the dam reaches the cell with that lag
+    '''
+
+    import numpy as np
+    import scipy.sparse
+
+    if list_lag_weights is None:
+        list_lag_weights = [np.ones(np.shape(lag_days)) for lag_days in list_lag_days]
+    #=== Flatten (cell, kernel tap) of each dam ===#
+    list_lag = [np.asarray(list_lag_days[i], dtype=int).reshape(len(delta_store['dam_cells'][i]), -1) \
+                for i in dams]
+    cells = np.concatenate([np.repeat(delta_store['dam_cells'][i], lag.shape[1]) \
+                            for i, lag in zip(dams, list_lag)]).astype(int)
+    columns = np.concatenate([np.full(lag.size, n, dtype=int) for n, lag in enumerate(list_lag)])
+    lags = np.concatenate([lag.ravel() for lag in list_lag])
+    weights = np.concatenate([np.asarray(list_lag_weights[i], dtype=float).ravel() for i in dams])
+
+    routing = []
+    for lag in np.unique(lags[weights!=0]):
+        ind = (lags==lag) & (weights!=0)
+        # only the cells reached with this lag are rows of the matrix
+        cells_lag, rows = np.unique(cells[ind], return_inverse=True)
+        matrix = scipy.sparse.csr_matrix((weights[ind], (rows, columns[ind])), \
+                                         shape=(len(cells_lag), len(dams)))
+        routing.append((int(lag), cells_lag, matrix))
+
+    return routing
+
+#====================================================================#
+#====================================================================#
+
+def add_routed_delta(delta, routing, t_start, dflow):
+    ''' This function adds the lagged flow changes of a set of dams to the delta buffer of a sparse delta store, for all their downstream cells at once; for each lag, only the cells reached with that lag are updated
+
+    Input:
+        delta: np.array of the delta buffer (time, modified cell) [cfs] (delta_store['delta']); modified in place
+        routing: routing matrices of the dams (see compile_routing_matrices)
+        t_start: time index (in the delta buffer) of the first time step of dflow
+        dflow: 2-D np.array of flow change at each dam (release - inflow) (dam, time) [cfs]; 0 when a dam is not operating
+
+    Return: delta (same object, modified)
+    '''
+
+    ntime = dflow.shape[1]
+    for lag, cells, matrix in routing:
+        a = t_start + lag
+        b = min(a + ntime, delta.shape[0])
+        # Contributions later than the delta buffer are dropped
+        if b <= a:
+            continue
+        delta[a:b, cells] += matrix.dot(dflow[:, :b-a]).T
+
+    return delta
+
+#====================================================================#
+#====================================================================#
+
+def apply_sparse_delta(flow, delta_store):
+    ''' This function adds all accumulated flow changes onto the flow field in one scatter-add
+
+    Input:
+        flow: np.array of streamflow field (time, lat, lon) [cfs]; modified in place
+        delta_store: sparse delta store (see init_sparse_delta); the first flow.shape[0] time steps of the delta buffer are applied
+
+    Return: flow (same object, modified)
+    '''
+
+    import numpy as np
+
+    np.add.at(flow, (slice(None), delta_store['rows'], delta_store['cols']), \
+              delta_store['delta'][:flow.shape[0]])
+
+    return flow
+
+#====================================================================#
+#====================================================================#
+
+def calc_chunk_length(memory_budget_mb, ntime, nlat, nlon, ncell, max_lag, n_grid_arrays=1, itemsize=8):
+    ''' This function calculates the number of time steps per chunk for streaming over the time axis within a memory budget
+
+    Input:
+        memory_budget_mb: memory budget for grid-sized chunk arrays [MB]; None for no limit (one chunk)
+        ntime: total number of time steps
+        nlat, nlon: grid size
+        ncell: number of modified cells (see init_sparse_delta)
+        max_lag: maximum flow time lag from a dam to its downstream cells [time step]
+        n_grid_arrays: number of (time, lat, lon) chunk arrays alive at once (the flow field is modified in place, and the flow change is written through a small buffer; see write_delta_nc_chunk)
+        itemsize: bytes per value of the chunk arrays (8 for float64, 4 for float32)
+
+    Return:
+        number of time steps per chunk (at least 1)
+    '''
+
+    if memory_budget_mb is None:
+        return ntime
+
+    bytes_per_step = itemsize * (n_grid_arrays * nlat * nlon + ncell)
+    # the delta buffer of the modified cells also holds max_lag steps in flight
+    budget = memory_budget_mb * 1024.0 * 1024.0 - float(itemsize) * ncell * max_lag
+    chunk_length = int(budget // bytes_per_step)
+
+    return max(1, min(ntime, chunk_length))
+
+#====================================================================#
+#====================================================================#
+
+def create_nc_coordinates(path, time, lat, lon, unlimited_time=False):
+    ''' This function creates a netCDF file with the lat, lon and time coordinates, encoded as xray's to_netcdf encodes them (time units, calendar and data type, fill values and attributes), to which data variables are added (see create_nc_data_variable)
+
+    Input:
+        path: output netCDF file path
+        time: pd.DatetimeIndex of time coordinate
+        lat, lon: np.array of lat and lon coordinates
+        unlimited_time: True for an unlimited time dimension (so that a restart run can append to the file, see open_nc_append); False for a fixed one, as xray writes
+
+    Return:
+        netCDF4.Dataset opened for writing
+    '''
+
+    from netCDF4 import Dataset
+    import os
+    import tempfile
+    import xray
+
+    #=== Let xray encode the coordinates into a small template file ===#
+    ds = xray.Dataset(coords={'lat': (['lat'], lat), 'lon': (['lon'], lon), \
+                              'time': (['time'], time.values)})
+    fd, template_path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    ds.to_netcdf(template_path, format='NETCDF4_CLASSIC')
+
+    #=== Copy the encoded coordinates as they are ===#
+    template = Dataset(template_path, 'r')
+    nc = Dataset(path, 'w', format='NETCDF4_CLASSIC')
+    nc.setncatts(dict((key, template.getncattr(key)) for key in template.ncattrs()))
+    for name, dim in template.dimensions.items():
+        nc.createDimension(name, None if (name=='time' and unlimited_time) else len(dim))
+    for name, var_template in template.variables.items():
+        var_template.set_auto_maskandscale(False)
+        attrs = dict((key, var_template.getncattr(key)) for key in var_template.ncattrs())
+        var = nc.createVariable(name, var_template.dtype, var_template.dimensions, \
+                                fill_value=attrs.pop('_FillValue', None))
+        var.set_auto_maskandscale(False)
+        var.setncatts(attrs)
+        var[:] = var_template[:]
+    template.close()
+    os.remove(template_path)
+
+    return nc
+
+#====================================================================#
+#====================================================================#
+
+def create_nc_data_variable(nc, varname, dtype, dims, units, long_name):
+    ''' This function adds a data variable to an open netCDF file, with the attributes and fill value xray's to_netcdf would give it; data are written later (see write_grid_nc_chunk)
+
+    Input:
+        nc: netCDF4.Dataset opened for writing
+        varname: variable name
+        dtype: data type of the variable (e.g., np.float32)
+        dims: tuple of dimension names
+        units, long_name: attributes of the variable
+    '''
+
+    import numpy as np
+    import xray
+    import xray.conventions
+
+    #=== Encode an empty variable of the same type to get the attributes ===#
+    var = xray.conventions.encode_cf_variable(\
+                xray.Variable(dims, np.empty((0,)*len(dims), dtype=dtype), \
+                              attrs={'units': units, 'long_name': long_name}))
+    attrs = dict(var.attrs)
+    nc_var = nc.createVariable(varname, var.dtype, dims, fill_value=attrs.pop('_FillValue', None))
+    nc_var.setncatts(attrs)
+
+#====================================================================#
+#====================================================================#
+
+def create_grid_nc(path, varname, time, lat, lon, dtype, units, long_name, scenarios=None, members=None, unlimited_time=False):
+    ''' This function creates a netCDF file with one (time, lat, lon) variable, to be filled in chunk by chunk (see write_grid_nc_chunk); without scenarios and members, the file holds the same variables, encoding and attributes as one written at once by xray's to_netcdf
+
+    Input:
+        path: output netCDF file path
+        varname: variable name
+        time: pd.DatetimeIndex of time coordinate
+        lat, lon: np.array of lat and lon coordinates
+        dtype: data type of the variable (e.g., np.float32)
+        units, long_name: attributes of the variable
+        scenarios: list of scenario names; if given, the variable has a leading 'scenario' dimension (scenario, time, lat, lon)
+        members: list of RVIC output paths of ensemble members; if given, the variable has a leading 'member' dimension ([member, [scenario,]] time, lat, lon)
+        unlimited_time: True for an unlimited time dimension, so that a restart run can append (see create_nc_coordinates)
+
+    Return:
+        netCDF4.Dataset opened for writing (close it after all chunks are written)
+
+    Require:
+        create_nc_coordinates
+        create_nc_data_variable
+    '''
+
+    nc = create_nc_coordinates(path, time, lat, lon, unlimited_time)
+    dims = ('time', 'lat', 'lon')
+    if scenarios is not None:
+        add_scenario_dimension(nc, scenarios)
+        dims = ('scenario',) + dims
+    if members is not None:
+        add_member_dimension(nc, members)
+        dims = ('member',) + dims
+    create_nc_data_variable(nc, varname, dtype, dims, units, long_name)
+
+    return nc
+
+#====================================================================#
+#====================================================================#
+
+def write_grid_nc_chunk(nc, varname, t_start, data, i_scenario=None, i_member=None):
+    ''' This function writes a time chunk of a (time, ...) variable into an open netCDF file
+
+    Input:
+        nc: netCDF4.Dataset opened for writing (see create_grid_nc)
+        varname: variable name
+        t_start: time index of the first time step of the chunk
+        data: np.array of the chunk (time, ...)
+        i_scenario: index of the scenario, if the variable has a scenario dimension
+        i_member: index of the ensemble member, if the variable has a member dimension
+    '''
+
+    index = tuple([i for i in (i_member, i_scenario) if i is not None])
+    nc.variables[varname][index + (slice(t_start, t_start+data.shape[0]),)] = data
+
+#====================================================================#
+#====================================================================#
+
+def add_scenario_dimension(nc, scenarios):
+    ''' This function adds a 'scenario' dimension and coordinate to an open netCDF file; scenario names are stored in the 'names' attribute (comma separated), since classic netCDF has no string variables '''
+
+    import numpy as np
+
+    nc.createDimension('scenario', len(scenarios))
+    var = nc.createVariable('scenario', np.int32, ('scenario',))
+    var.names = ','.join([str(name) for name in scenarios])
+    var[:] = np.arange(len(scenarios))
+
+#====================================================================#
+#====================================================================#
+
+def add_member_dimension(nc, members):
+    ''' This function adds a 'member' dimension and coordinate to an open netCDF file; the RVIC output path of each member is stored in the 'rvic_output_path' attribute (comma separated) '''
+
+    import numpy as np
+
+    nc.createDimension('member', len(members))
+    var = nc.createVariable('member', np.int32, ('member',))
+    var.rvic_output_path = ','.join(members)
+    var[:] = np.arange(len(members))
+
+#====================================================================#
+#====================================================================#
+
+def write_delta_nc_chunk(nc, varname, t_start, flow, rows, cols, delta_cells, max_bytes=100*1024*1024, i_scenario=None, i_member=None):
+    ''' This function writes flow change of a time chunk into an open netCDF file; since flow only changes at the modified cells, the full (time, lat, lon) flow change is never built - it is written through a buffer of at most max_bytes
+
+    Input:
+        nc: netCDF4.Dataset opened for writing (see create_grid_nc)
+        varname: variable name
+        t_start: time index of the first time step of the chunk
+        flow: np.array of flow field of the chunk (time, lat, lon); flow change is 0 where flow is valid and NaN where flow is NaN
+        rows, cols: np.array of grid index of the modified cells
+        delta_cells: np.array of flow change at the modified cells (time, modified cell)
+        max_bytes: maximum size of the write buffer [bytes]
+        i_scenario: index of the scenario, if the variable has a scenario dimension
+        i_member: index of the ensemble member, if the variable has a member dimension
+    '''
+
+    ntime, nlat, nlon = flow.shape
+    steps = max(1, int(max_bytes // (nlat * nlon * flow.itemsize)))
+
+    for a in range(0, ntime, steps):
+        b = min(ntime, a+steps)
+        buf = flow[a:b] - flow[a:b]  # 0 for valid flow, NaN for missing flow
+        buf[:, rows, cols] = delta_cells[a:b]
+        write_grid_nc_chunk(nc, varname, t_start+a, buf, i_scenario, i_member)
+
+#====================================================================#
+#====================================================================#
+
+def create_network_nc(path, time, lat, lon, rows, cols, dtype, rvic_output_path, scenarios=None, members=None, unlimited_time=False):
+    ''' This function creates a netCDF file of regulated flow on the modified cells only (dam cells and their downstream cells), as a 1-D "cell" dimension; to be filled in chunk by chunk (see write_grid_nc_chunk)
+
+    Input:
+        path: output netCDF file path
+        time: pd.DatetimeIndex of time coordinate
+        lat, lon: np.array of lat and lon coordinates of the full grid
+        rows, cols: np.array of grid index of the modified cells
+        dtype: data type of the flow variables (e.g., np.float32)
+        rvic_output_path: original RVIC output path (grid format); stored so that the full grid can be rebuilt (see read_network_flow_grid)
+        scenarios: list of scenario names; if given, the data variables have a leading 'scenario' dimension
+        members: list of RVIC output paths of ensemble members; if given, the data variables have a leading 'member' dimension (rvic_output_path is then not used)
+        unlimited_time: True for an unlimited time dimension, so that a restart run can append (see create_nc_coordinates)
+
+    Return:
+        netCDF4.Dataset opened for writing, with variables 'streamflow' and 'flow_delta' (time, cell); close it after all chunks are written
+
+    Require:
+        create_nc_coordinates
+        create_nc_data_variable
+    '''
+
+    import numpy as np
+
+    #=== Full grid coordinates ===#
+    nc = create_nc_coordinates(path, time, lat, lon, unlimited_time)
+    dims = ('time', 'cell')
+    if scenarios is not None:
+        add_scenario_dimension(nc, scenarios)
+        dims = ('scenario',) + dims
+    if members is not None:
+        add_member_dimension(nc, members)
+        dims = ('member',) + dims
+    else:
+        nc.rvic_output_path = rvic_output_path
+    nc.createDimension('cell', len(rows))
+
+    #=== Modified cells: coordinates and index back to the grid ===#
+    var = nc.createVariable('cell_lat', np.float64, ('cell',))
+    var[:] = lat[rows]
+    var = nc.createVariable('cell_lon', np.float64, ('cell',))
+    var[:] = lon[cols]
+    var = nc.createVariable('cell_row', np.int32, ('cell',))
+    var.long_name = 'lat index of the cell in the full grid'
+    var[:] = rows
+    var = nc.createVariable('cell_col', np.int32, ('cell',))
+    var.long_name = 'lon index of the cell in the full grid'
+    var[:] = cols
+
+    #=== Data variables ===#
+    create_nc_data_variable(nc, 'streamflow', dtype, dims, 'cfs', 'Simulated regulated streamflow')
+    create_nc_data_variable(nc, 'flow_delta', dtype, dims, 'cfs', \
+                            'Simulated streamflow difference (regulated-unregulated')
+
+    return nc
+
+#====================================================================#
+#====================================================================#
+
+def read_network_flow_grid(path, varname='streamflow', t_start=0, t_end=None, rvic_output_path=None, i_scenario=None, i_member=None):
+    ''' This function rebuilds the full (time, lat, lon) grid of a time range from a network-format output file (see create_network_nc); only the requested time range of the original RVIC file is read
+
+    Input:
+        path: network-format output netCDF file path
+        varname: 'streamflow' for regulated flow; 'flow_delta' for flow change
+        t_start, t_end: time index range to read (t_end exclusive; None for the end of record)
+        rvic_output_path: original RVIC output path (grid format); None for the path stored in the file (of the member, if the file has a member dimension)
+        i_scenario: index of the scenario, if the file has a scenario dimension
+        i_member: index of the ensemble member, if the file has a member dimension
+
+    Return:
+        xray.DataArray of the full grid (time, lat, lon) [cfs]
+    '''
+
+    from netCDF4 import Dataset
+    import numpy as np
+    import pandas as pd
+    import xray
+
+    #=== Load modified cells ===#
+    nc = Dataset(path, 'r')
+    if rvic_output_path is None and i_member is not None:
+        rvic_output_path = nc.variables['member'].rvic_output_path.split(',')[i_member]
+    elif rvic_output_path is None:
+        rvic_output_path = nc.rvic_output_path
+    rows = nc.variables['cell_row'][:]
+    cols = nc.variables['cell_col'][:]
+    if t_end is None:
+        t_end = len(nc.dimensions['time'])
+    index = tuple([i for i in (i_member, i_scenario) if i is not None])
+    data_cells = np.asarray(nc.variables[varname][index + (slice(t_start, t_end),)])
+    nc.close()
+
+    #=== Load original flow of the time range ===#
+    ds_rvic = xray.open_dataset(rvic_output_path)
+    ds_rvic = ds_rvic.isel(time=slice(0,-1))   # delete last junk date
+    da = ds_rvic['streamflow'].isel(time=slice(t_start, t_end)).load()
+    flow = da.values
+    flow *= pow(1000./25.4/12, 3)  # convert m3/s to cfs
+    if varname=='flow_delta':
+        flow -= flow  # 0 for valid flow, NaN for missing flow
+
+    #=== Put modified cells back ===#
+    flow[:, rows, cols] = data_cells
+    da.attrs = {'units': 'cfs'}
+    ds_rvic.close()
+
+    return da
+
+#====================================================================#
+#====================================================================#
+
+def calc_dam_cache_key(inflow, rule_curve, params, cells, lag_days, lag_weights=None):
+    ''' This function calculates a content hash of all inputs of one dam's simulation, used as the key of the per-dam result cache
+
+    Input:
+        inflow: np.array of inflow to the dam (including flow changes from upstream dams) [cfs]
+        rule_curve: np.array of rule curve storage [ft3]
+        params: list of scalar parameters (e.g., init_S, start index, top_vol, bot_vol, max_flow, min_flow)
+        cells, lag_days: np.array of the dam's network path (modified cell positions) and time lag to each cell [time step] (depends on wave velocity)
+        lag_weights: np.array of weight of each lag (see calc_lag_kernel); None for weight 1
+
+    Return:
+        hex string of the hash
+    '''
+
+    import hashlib
+    import numpy as np
+
+    h = hashlib.sha1()
+    list_x = [inflow, rule_curve, cells, lag_days]
+    if lag_weights is not None:
+        list_x.append(lag_weights)
+    for x in list_x:
+        x = np.ascontiguousarray(x)
+        h.update(str(x.dtype).encode())
+        h.update(str(x.shape).encode())
+        h.update(x.tobytes())
+    h.update(repr([float(p) for p in params]).encode())
+
+    return h.hexdigest()
+
+#====================================================================#
+#====================================================================#
+
+def load_dam_cache(cache_dir, key):
+    ''' This function loads one dam's cached simulation results
+
+    Input:
+        cache_dir: cache directory
+        key: cache key (see calc_dam_cache_key)
+
+    Return:
+        a dict of 'release' [cfs], 'storage' [acre-feet] (np.array), 'final_S' [ft3] and 'diagnostics' (np.array, see DIAGNOSTIC_NAMES); None if not in the cache
+    '''
+
+    import numpy as np
+    import os
+
+    path = os.path.join(cache_dir, '{}.npz'.format(key))
+    if not os.path.isfile(path):
+        return None
+
+    npz = np.load(path)
+    # cached before diagnostics were added, or with other diagnostics
+    if 'diagnostics' not in npz.files or npz['diagnostics'].shape!=(len(DIAGNOSTIC_NAMES),):
+        npz.close()
+        return None
+    result = {'release': npz['release'], 'storage': npz['storage'], \
+              'final_S': float(npz['final_S']), 'diagnostics': npz['diagnostics']}
+    npz.close()
+
+    return result
+
+#====================================================================#
+#====================================================================#
+
+def save_dam_cache(cache_dir, key, release, storage, final_S, diagnostics):
+    ''' This function saves one dam's simulation results to the cache
+
+    Input:
+        cache_dir: cache directory (created if not existing)
+        key: cache key (see calc_dam_cache_key)
+        release, storage: np.array of release [cfs] and storage [acre-feet]
+        final_S: storage at the end of the last time step [ft3]
+        diagnostics: np.array of operational diagnostics (see DIAGNOSTIC_NAMES)
+    '''
+
+    import numpy as np
+    import os
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    np.savez(os.path.join(cache_dir, '{}.npz'.format(key)), \
+             release=release, storage=storage, final_S=final_S, diagnostics=diagnostics)
+
+#====================================================================#
+#====================================================================#
+
+def read_scenario_table(path, dam_numbers, max_flow, min_flow, top_vol, bot_vol, wave_velocity):
+    ''' This function reads a table of parameter scenarios, and returns parameters of every dam for every scenario
+
+    Input:
+        path: scenario csv file (None for one scenario 'default' with all default values); columns:
+                scenario: scenario name (required); a scenario may span several rows
+                dam_number: (optional) dam the row applies to; empty or missing for all dams
+                max_flow_cfs, min_flow_cfs, top_vol_acre_feet, bot_vol_acre_feet: (optional) parameter values
+                rule_curve_scale: (optional) factor multiplied to the rule curve
+                wave_velocity: (optional) wave velocity of the scenario [m/s]
+              empty values keep the default (dam info csv; scale 1; [NETWORK] wave_velocity);
+              rows for all dams are applied before rows for a single dam
+        dam_numbers: list of dam numbers (in the order of the dam info)
+        max_flow, min_flow, top_vol, bot_vol: np.array of default values of each dam
+        wave_velocity: default wave velocity [m/s]
+
+    Return:
+        a dict of:
+            'names': list of scenario names
+            'max_flow', 'min_flow', 'top_vol', 'bot_vol', 'rule_curve_scale': 2-D np.array (scenario, dam)
+            'wave_velocity': np.array (scenario)
+
+    Raise:
+        ValueError if a row has no scenario name, or names a dam that is not in dam_numbers
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    if path is None:
+        df = pd.DataFrame({'scenario': ['default']})
+    else:
+        df = pd.read_csv(path)
+    if 'scenario' not in df.columns or np.any(df['scenario'].isnull()):
+        raise ValueError('every row of {} needs a scenario name'.format(path))
+    if 'dam_number' not in df.columns:
+        df['dam_number'] = np.nan
+    list_names = list(pd.unique(df['scenario'].astype(str)))
+    dict_dam_index = dict((int(n), i) for i, n in enumerate(dam_numbers))
+    unknown_dams = sorted(set(int(n) for n in df['dam_number'].dropna()) - set(dict_dam_index))
+    if len(unknown_dams)>0:
+        raise ValueError('dam numbers {} in {} are not in the dam info'.format(unknown_dams, path))
+
+    nscen = len(list_names)
+    ndam = len(dam_numbers)
+    scenario = {'names': list_names}
+    for key, default in [('max_flow', max_flow), ('min_flow', min_flow), \
+                         ('top_vol', top_vol), ('bot_vol', bot_vol), \
+                         ('rule_curve_scale', np.ones(ndam))]:
+        scenario[key] = np.tile(np.asarray(default, dtype=float), (nscen, 1))
+    scenario['wave_velocity'] = np.full(nscen, float(wave_velocity))
+
+    dict_columns = {'max_flow_cfs': 'max_flow', 'min_flow_cfs': 'min_flow', \
+                    'top_vol_acre_feet': 'top_vol', 'bot_vol_acre_feet': 'bot_vol', \
+                    'rule_curve_scale': 'rule_curve_scale'}
+    # rows for all dams first, then rows for single dams
+    df = pd.concat([df[df['dam_number'].isnull()], df[df['dam_number'].notnull()]])
+    for _, row in df.iterrows():
+        s = list_names.index(str(row['scenario']))
+        if pd.isnull(row['dam_number']):
+            ind_dam = slice(None)
+        else:
+            ind_dam = dict_dam_index[int(row['dam_number'])]
+        for column, key in dict_columns.items():
+            if column in df.columns and not pd.isnull(row[column]):
+                scenario[key][s, ind_dam] = row[column]
+        if 'wave_velocity' in df.columns and not pd.isnull(row['wave_velocity']):
+            scenario['wave_velocity'][s] = row['wave_velocity']
+
+    return scenario
+
+#====================================================================#
+#====================================================================#
+
+def find_rvic_output_paths(rvic_output_path):
+    ''' This function lists the RVIC output files (grid format) of all ensemble members
+
+    Input:
+        rvic_output_path: one path, a glob pattern (e.g., '/path/trace_*.nc'), or a list of paths/patterns
+
+    Return:
+        list of RVIC output paths of ensemble members (sorted within each glob pattern); None if rvic_output_path is a single path (not an ensemble)
+    '''
+
+    import glob
+
+    if not isinstance(rvic_output_path, list):
+        if not glob.has_magic(rvic_output_path):
+            return None
+        rvic_output_path = [rvic_output_path]
+
+    list_paths = []
+    for path in rvic_output_path:
+        if glob.has_magic(path):
+            list_paths += sorted(glob.glob(path))
+        else:
+            list_paths.append(path)
+
+    return list_paths
+
+#====================================================================#
+#====================================================================#
+
+def write_checkpoint(path, date, start_date, dam_numbers, S, release, delta_in_flight, rows, cols):
+    ''' This function writes the model state at the end of a run, from which a later run can restart (see read_checkpoint)
+
+    Input:
+        path: checkpoint file path (.npz)
+        date: datetime of the last time step of the run
+        start_date: datetime of the start of reservoir operation of the run (start_date_to_run); a restart must keep it
+        dam_numbers: list of dam numbers (in the order of the dam info)
+        S: np.array of storage of each dam at the end of the run (run, dam) [ft3] (NaN for dams not operated yet)
+        release: np.array of release of each dam on the last time step of the run (run, dam) [cfs] (NaN for dams not operated yet); the operating policy's last release, from which a restart continues
+        delta_in_flight: np.array of lagged flow change beyond the last time step (run, lag, modified cell) [cfs]
+        rows, cols: np.array of grid index of the modified cells
+    '''
+
+    import numpy as np
+
+    with open(path, 'wb') as f:
+        np.savez(f, date=np.array(date.strftime('%Y-%m-%d %H:%M:%S')), \
+                 start_date=np.array(start_date.strftime('%Y-%m-%d %H:%M:%S')), \
+                 dam_numbers=np.asarray(dam_numbers), S=S, release=release, \
+                 delta_in_flight=delta_in_flight, rows=rows, cols=cols)
+
+#====================================================================#
+#====================================================================#
+
+def read_checkpoint(path):
+    ''' This function reads a checkpoint written by write_checkpoint
+
+    Return:
+        a dict of:
+            'date': pd.Timestamp of the last time step of the checkpointed run
+            'start_date': pd.Timestamp of the start of reservoir operation of the checkpointed run
+            'dam_numbers', 'S', 'release', 'delta_in_flight', 'rows', 'cols': see write_checkpoint
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    data = np.load(path)
+    checkpoint = dict((key, data[key]) for key in data.files)
+    checkpoint['date'] = pd.Timestamp(str(checkpoint['date']))
+    checkpoint['start_date'] = pd.Timestamp(str(checkpoint['start_date'])) \
+                               if 'start_date' in checkpoint else None
+    data.close()
+
+    return checkpoint
+
+#====================================================================#
+#====================================================================#
+
+def open_nc_append(path, time, last_date):
+    ''' This function opens an existing output netCDF file (see create_grid_nc and create_network_nc; written with an unlimited time dimension) to append new time steps, and extends its time coordinate
+
+    Input:
+        path: output netCDF file path
+        time: pd.DatetimeIndex of the time steps to append
+        last_date: datetime of the last time step already in the file (to check that the file matches the restart)
+
+    Return:
+        nc: netCDF4.Dataset opened for appending (close it after all chunks are written)
+        t_offset: time index in the file of time[0]
+    '''
+
+    from netCDF4 import Dataset, num2date, date2num
+    import pandas as pd
 
+    nc = Dataset(path, 'a')
+    if not nc.dimensions['time'].isunlimited():
+        nc.close()
+        raise ValueError('{} has a fixed time dimension; it was not written by a run with checkpoint_path'.format(path))
+    var = nc.variables['time']
+    t_offset = len(var)
+    file_last_date = pd.Timestamp(str(num2date(var[t_offset-1], var.units, var.calendar)))
+    if file_last_date!=pd.Timestamp(last_date):
+        nc.close()
+        raise ValueError('last date of {} ({}) does not match the checkpoint ({})'.format(\
+                                                    path, file_last_date, last_date))
+    var[t_offset:t_offset+len(time)] = date2num(time.to_pydatetime(), var.units, var.calendar)
 
+    return nc, t_offset
@@ -9,8 +9,26 @@ import matplotlib.pyplot as plt
 import os
 import my_functions
 
+# Default values of optional config options
+default_config = {'DAM_INFO': {'rule_curve_cache': None, \
+                               'sea_table_dir': None, \
+                               'turbine_efficiency': 0.85}, \
+                  'NETWORK': {'lag_method': 'round', \
+                              'diffusion': None, \
+                              'muskingum_x': None}, \
+                  'PARAM': {'batch_simulation': False, \
+                            'memory_budget_mb': None, \
+                            'dam_cache_dir': None, \
+                            'engine': 'dam_major', \
+                            'restart_checkpoint': None, \
+                            'checkpoint_path': None, \
+                            'policy_module': None, \
+                            'precision': None}, \
+                  'OUTPUT': {'output_format': 'grid'}, \
+                  'SCENARIO': {'scenario_csv': None}}
+
 # Read in config file
-cfg = my_functions.read_config(sys.argv[1])
+cfg = my_functions.read_config(sys.argv[1], default_config=default_config)
 
 # Process dates
 start_date_to_run = dt.datetime(cfg['PARAM']['start_date_to_run'][0], \
@@ -25,97 +43,633 @@ end_date_to_run = dt.datetime(cfg['PARAM']['end_date_to_run'][0], \
 #====================================================================#
 #=== Load dam info ===#
 df_dam_info = pd.read_csv(cfg['DAM_INFO']['dam_info_csv'])
+#=== Load store of parsed rule curves (if caching) ===#
+if cfg['DAM_INFO']['rule_curve_cache'] is not None:
+    rule_curve_store = my_functions.read_rule_curve_store(cfg['DAM_INFO']['rule_curve_cache'])
+else:
+    rule_curve_store = None
+#=== Load operating policy module (if a custom policy is used) ===#
+if cfg['PARAM']['policy_module'] is not None:
+    import imp
+    policy_module = imp.load_source('policy_module', cfg['PARAM']['policy_module'])
+else:
+    policy_module = None
 #=== Load network info ===@
 ds_network = xray.open_dataset(cfg['NETWORK']['route_nc'])
 da_flowdir = ds_network['Flow_Direction']
 da_flowdis = ds_network['Flow_Distance']
 velocity = cfg['NETWORK']['wave_velocity']  # wave velocity
+#=== Compile network into integer downstream index (one-time) ===#
+network = my_functions.compile_routing_network(da_flowdir, da_flowdis)
+
+#=== Open original flow data (RVIC grid format); data are read chunk by chunk ===#
+# Ensemble mode if rvic_output_path is a list or glob pattern of member files
+list_members = my_functions.find_rvic_output_paths(cfg['INPUT']['rvic_output_path'])
+if list_members is None:
+    list_ds_rvic = [xray.open_dataset(cfg['INPUT']['rvic_output_path'])]
+elif len(list_members)==0:
+    print 'Error: no RVIC output file found for the ensemble!'
+    exit()
+else:
+    print 'Ensemble of {} members'.format(len(list_members))
+    list_ds_rvic = [xray.open_dataset(path) for path in list_members]
+list_ds_rvic = [ds.isel(time=slice(0,-1)) for ds in list_ds_rvic]   # delete last junk date
+nmember = len(list_ds_rvic)
+ds_rvic = list_ds_rvic[0]
+for ds in list_ds_rvic[1:]:
+    if not (np.array_equal(ds['time'].values, ds_rvic['time'].values) \
+            and np.array_equal(ds['lat'].values, ds_rvic['lat'].values) \
+            and np.array_equal(ds['lon'].values, ds_rvic['lon'].values)):
+        print 'Error: ensemble members do not have the same time, lat and lon!'
+        exit()
+flow_dates = pd.to_datetime(ds_rvic['time'].values)
+ntime = len(flow_dates)
+nlat = len(ds_rvic['lat'])
+nlon = len(ds_rvic['lon'])
+# Length of a time step, from the time coordinate (daily or sub-daily) [s]
+try:
+    dt_seconds = my_functions.calc_time_step(flow_dates)
+except ValueError:
+    print 'Error: time steps of RVIC output are not uniform!'
+    exit()
+if dt_seconds>86400 or 86400%dt_seconds!=0:
+    print 'Error: time step of RVIC output must be one day or divide a day evenly!'
+    exit()
+print 'Time step: {} hours'.format(dt_seconds/3600.0)
+#=== Precision of streamflow, flow changes and output files ===#
+# None keeps the precision of RVIC output for streamflow and output files (flow changes in float64);
+# reservoir storage is always accumulated in float64
+if cfg['PARAM']['precision'] is None:
+    flow_dtype = ds_rvic['streamflow'].dtype
+    delta_dtype = np.dtype(float)
+elif cfg['PARAM']['precision'] in ['float32', 'float64']:
+    flow_dtype = np.dtype(cfg['PARAM']['precision'])
+    delta_dtype = flow_dtype
+else:
+    print 'Error: unsupported precision!'
+    exit()
+# Time index of the period to simulate reservoir operation (all time steps from the first day to the last day)
+start_day = dt.datetime(start_date_to_run.year, start_date_to_run.month, start_date_to_run.day)
+end_day = dt.datetime(end_date_to_run.year, end_date_to_run.month, end_date_to_run.day)
+t_run_start = flow_dates.searchsorted(start_day)
+t_run_end = flow_dates.searchsorted(end_day + dt.timedelta(days=1))  # exclusive
+dates_to_run = flow_dates[t_run_start:t_run_end]
+# Day of each time step, as integer offset from the first day (all time steps of a day share the rule curve of the day)
+day_offset = np.asarray((dates_to_run.normalize() - start_day).days)
 
 #====================================================================#
-# Simulate each dam and modify flow downstream
+# Prepare dams
 #====================================================================#
-#=== Load original flow data (RVIC grid format) ===#
-ds_rvic = xray.open_dataset(cfg['INPUT']['rvic_output_path'])
-ds_rvic = ds_rvic.isel(time=slice(0,-1))   # delete last junk date
-da_rvic_flow = ds_rvic['streamflow'] * pow(1000./25.4/12, 3)  # convert m3/s to cfs
-da_flow = da_rvic_flow.copy()  # flow field, will be modified
-
-#=== Loop over each dam ===#
-# Dam list must be from upstream to downstream order!
+#=== Order dams from upstream to downstream based on the flow direction network ===#
+try:
+    dam_rows, dam_cols = zip(*[my_functions.find_grid_index(network, lat, lon, cfg['NETWORK']['dlatlon']) \
+                               for lat, lon in zip(df_dam_info['grid_lat'].values, \
+                                                   df_dam_info['grid_lon'].values)])
+except ValueError as e:
+    print 'Error: {}'.format(e)
+    exit()
+downstream_dam = my_functions.find_downstream_dams(network, dam_rows, dam_cols)
+dam_order, dam_levels = my_functions.order_dams_topologically(downstream_dam)
+list_level_dam_numbers = [df_dam_info['dam_number'].values[level].tolist() for level in dam_levels]
+print 'Dam network levels (upstream to downstream): {}'.format(list_level_dam_numbers)
+
+#=== Initialize sparse store of flow changes on dam and downstream cells ===#
+delta_store = my_functions.init_sparse_delta(network, dam_rows, dam_cols, 0)
+
+#=== Extract dam info and rule curves ===#
+list_dams = []  # list of dicts of dam info, in the order of the dam list
 for i in range(len(df_dam_info)):
-    #=== Extract dam info ===#
-    lat = df_dam_info.ix[i]['grid_lat']  # dam grid lat
-    lon = df_dam_info.ix[i]['grid_lon']  # dam grid lon
-    dam_number = df_dam_info.ix[i]['dam_number']  # dam number
-    dam_name = df_dam_info.ix[i]['dam_name']  # dam name
-    top_vol = df_dam_info.ix[i]['top_vol_acre_feet']  # reservoir top volumn [acre-feet]
-    bot_vol = df_dam_info.ix[i]['bot_vol_acre_feet']  # reservoir bottom volumn [acre-feet]
-    max_flow = df_dam_info.ix[i]['max_flow_cfs']  # max flow [cfs]
-    min_flow = df_dam_info.ix[i]['min_flow_cfs']  # min flow [cfs]
+    dam = {}
+    dam['lat'] = df_dam_info.ix[i]['grid_lat']  # dam grid lat
+    dam['lon'] = df_dam_info.ix[i]['grid_lon']  # dam grid lon
+    dam['row'], dam['col'] = dam_rows[i], dam_cols[i]  # dam grid index
+    dam['cell'] = delta_store['dam_cells'][i][0]  # position of the dam cell in delta_store
+    dam['dam_number'] = df_dam_info.ix[i]['dam_number']  # dam number
+    dam['dam_name'] = df_dam_info.ix[i]['dam_name']  # dam name
+    dam['top_vol'] = df_dam_info.ix[i]['top_vol_acre_feet']  # reservoir top volumn [acre-feet]
+    dam['bot_vol'] = df_dam_info.ix[i]['bot_vol_acre_feet']  # reservoir bottom volumn [acre-feet]
+    dam['max_flow'] = df_dam_info.ix[i]['max_flow_cfs']  # max flow [cfs]
+    dam['min_flow'] = df_dam_info.ix[i]['min_flow_cfs']  # min flow [cfs]
     year_operated = df_dam_info.ix[i]['year_operated_start_of_Calendar_year']
                     # year operation started
-    print 'Simulating dam {}...'.format(dam_number)
+    print 'Loading dam {}...'.format(dam['dam_number'])
     #=== Load and process rule curve ===#
     rule_curve_filename = os.path.join(cfg['DAM_INFO']['rule_curve_dir'], \
-                              'dam{}_{}.txt'.format(dam_number, dam_name.replace(' ', '_')))
-    s_rule_curve = my_functions.process_rule_curve(rule_curve_filename, \
+                              'dam{}_{}.txt'.format(dam['dam_number'], \
+                                                    dam['dam_name'].replace(' ', '_')))
+    rule_curve_annual = my_functions.load_rule_curve_annual(\
+                            rule_curve_filename, dam['dam_number'], rule_curve_store)
+    s_rule_curve = my_functions.expand_rule_curve(rule_curve_annual, \
                                     start_date_to_run, end_date_to_run) # [acre-feet]
-    # If year start operation is after the period considered, truncate the time before operation
-    s_rule_curve = s_rule_curve.truncate(before=dt.datetime(year_operated, 1, 1))
-    if len(s_rule_curve)==0:  # if no period is operating, do not simulate
-        continue
-        
-    #=== Extract original flow data from RVIC output ===#
-    s_rvic_flow = da_flow.loc[:,lat,lon].to_series()
-    #=== Simulate reservoir operation ===#
-    init_S = s_rule_curve.ix[0]  # set initial storage to the rule curve value of the first day of simulation
-    s_release, s_storage = my_functions\
-                .simulate_reservoir_operation(s_rvic_flow, s_rule_curve, \
-                                              init_S, top_vol, bot_vol, max_flow, min_flow)
-    #=== Modify flow for all downstream grid cells ===#
-    da_flow = my_functions.modify_flow_all_downstream_cell(\
-                        lat, lon, \
-                        orig_flow=s_rvic_flow, \
-                        release=s_release, da_flow=da_flow, dlatlon=cfg['NETWORK']['dlatlon'], \
-                        da_flowdir=da_flowdir, da_flowdis=da_flowdis, velocity=velocity)    
-    #=== Save storage ===#
-    df = pd.DataFrame()
-    df['year'] = s_storage.index.year
-    df['month'] = s_storage.index.month
-    df['day'] = s_storage.index.day
-    df['storage_acre_ft'] = s_storage.values
-    df[['year', 'month', 'day', 'storage_acre_ft']].\
-            to_csv('{}.storage.dam{}.txt'.format(cfg['OUTPUT']['out_flow_basepath'], \
-                                                 dam_number), \
-            sep='\t', index=False)
-    
+    # If year start operation is after the period considered, the time before operation is not operated
+    day_operated = max(0, (dt.datetime(year_operated, 1, 1) - start_day).days)
+    t_operated = day_offset.searchsorted(day_operated)  # first time step of operation in the period
+    # rule curve on each time step of the simulation period (NaN before operation) [acre-feet]
+    dam['rule_curve'] = np.where(np.arange(len(dates_to_run))>=t_operated, \
+                                 s_rule_curve.values[day_offset], np.nan)
+    dam['operated'] = t_operated<len(dates_to_run)  # if no period is operating, do not simulate
+    # Time index of the first time step of operation
+    dam['t_start'] = t_run_start + t_operated
+    list_dams.append(dam)
+
+#=== Storage-elevation-area tables (if given), packed for vectorized lookup ===#
+# a dam without table file has no water level and hydropower output
+if cfg['DAM_INFO']['sea_table_dir'] is not None:
+    list_tables = []
+    for dam in list_dams:
+        sea_table_filename = os.path.join(cfg['DAM_INFO']['sea_table_dir'], \
+                                 'dam{}_{}.txt'.format(dam['dam_number'], \
+                                                       dam['dam_name'].replace(' ', '_')))
+        if not os.path.isfile(sea_table_filename):
+            list_tables.append(None)
+            continue
+        try:
+            list_tables.append(my_functions.read_sea_table(sea_table_filename))
+        except ValueError as e:
+            print 'Error: {}'.format(e)
+            exit()
+    sea = my_functions.StorageElevationArea(list_tables, \
+                tailwater=df_dam_info['tailwater_elev_ft'].values \
+                          if 'tailwater_elev_ft' in df_dam_info else None, \
+                max_turbine_flow=df_dam_info['max_turbine_flow_cfs'].values \
+                                 if 'max_turbine_flow_cfs' in df_dam_info else None, \
+                efficiency=cfg['DAM_INFO']['turbine_efficiency'])
+else:
+    sea = None
+
+#=== Save parsed rule curves for later runs ===#
+if rule_curve_store is not None:
+    my_functions.write_rule_curve_store(cfg['DAM_INFO']['rule_curve_cache'], rule_curve_store)
+
+#=== Parameters of each scenario (scenario, dam) ===#
+# Several parameter sets, if given, are simulated together along a scenario axis
+scenario_csv = cfg['SCENARIO']['scenario_csv'] if 'SCENARIO' in cfg else None
+try:
+    scenario = my_functions.read_scenario_table(scenario_csv, \
+                        [dam['dam_number'] for dam in list_dams], \
+                        max_flow=[dam['max_flow'] for dam in list_dams], \
+                        min_flow=[dam['min_flow'] for dam in list_dams], \
+                        top_vol=[dam['top_vol'] for dam in list_dams], \
+                        bot_vol=[dam['bot_vol'] for dam in list_dams], \
+                        wave_velocity=velocity)
+except ValueError as e:
+    print 'Error: {}'.format(e)
+    exit()
+nscen = len(scenario['names'])
+list_scenarios = scenario['names'] if scenario_csv is not None else None  # for output
+if list_scenarios is not None:
+    print 'Scenarios: {}'.format(list_scenarios)
+#=== Flow time lag to each dam cell and its downstream cells, for each scenario [time step] ===#
+# a kernel of whole-time-step lags and weights (cell, tap) for each dam
+list_lag_days = []
+list_lag_weights = []
+for k in range(nscen):
+    try:
+        list_kernel = [my_functions.calc_lag_kernel(delta_store['dam_distance'][i], \
+                                                    scenario['wave_velocity'][k], \
+                                                    method=cfg['NETWORK']['lag_method'], \
+                                                    diffusion=cfg['NETWORK']['diffusion'], \
+                                                    muskingum_x=cfg['NETWORK']['muskingum_x'], \
+                                                    dt=dt_seconds) \
+                       for i in range(len(list_dams))]
+    except ValueError as e:
+        print 'Error: {}'.format(e)
+        exit()
+    list_lag_days.append([kernel[0] for kernel in list_kernel])
+    list_lag_weights.append([kernel[1] for kernel in list_kernel])
+#=== Runs: every (ensemble member, scenario) pair ===#
+list_runs = [(m, k) for m in range(nmember) for k in range(nscen)]
+nrun = len(list_runs)
+
+#=== Group dams for simulation ===#
+if cfg['PARAM']['engine']=='time_major':
+    # All dams together in one pass over time (see my_functions.simulate_network_time_major)
+    list_dam_groups = [dam_order]
+elif cfg['PARAM']['engine']!='dam_major':
+    print 'Error: unsupported engine!'
+    exit()
+elif cfg['PARAM']['batch_simulation']:
+    # Dams in the same network level are independent and simulated together in one batch
+    list_dam_groups = dam_levels
+else:
+    # One dam at a time, from upstream to downstream
+    list_dam_groups = [[i] for i in dam_order]
+list_dam_groups = [[i for i in dam_group if list_dams[i]['operated']] \
+                   for dam_group in list_dam_groups]
+list_dam_groups = [dam_group for dam_group in list_dam_groups if len(dam_group)>0]
+#=== Dam-to-dam links for the time-major engine ===#
+# (upstream dam, downstream dam, position of the downstream dam cell in the upstream dam's path),
+# for every dam downstream of each dam
+list_dam_links = []
+for i in range(len(list_dams)):
+    d = downstream_dam[i]
+    while d>=0:
+        j = np.where(delta_store['dam_cells'][i]==list_dams[d]['cell'])[0][0]
+        list_dam_links.append((i, d, j))
+        d = downstream_dam[d]
+# The per-dam result cache only applies to the dam-major engine with the default policy
+use_dam_cache = cfg['PARAM']['dam_cache_dir'] is not None and cfg['PARAM']['engine']=='dam_major' \
+                and policy_module is None
+
 #====================================================================#
-# Save modified streamflow to netCDF file
+# Simulate dams and modify flow downstream, chunk by chunk over time
 #====================================================================#
+#=== Determine chunk length ===#
+ncell = len(delta_store['rows'])
+max_lag = max([lag_days.max() for list_lag in list_lag_days for lag_days in list_lag] + [0])
+# grid arrays alive at once: the flow of all members, plus one member being read into it
+chunk_length = my_functions.calc_chunk_length(cfg['PARAM']['memory_budget_mb'], \
+                                              ntime, nlat, nlon, ncell*nrun, max_lag, \
+                                              n_grid_arrays=nmember+1, \
+                                              itemsize=max(flow_dtype.itemsize, delta_dtype.itemsize))
+
+#=== Initialize ===#
+S = np.full((nrun, len(list_dams)), np.nan)  # storage at the end of the previous chunk [ft3]
+# release on the last time step of the previous chunk [cfs]; the operating policy continues from it
+release_last = np.full((nrun, len(list_dams)), np.nan)
+storage_all = np.full((nrun, len(list_dams), len(dates_to_run)), np.nan)  # [acre-feet]
+# water level [ft], surface area [acres], head [ft] and hydropower [MW], if tables are given
+list_hydro_keys = ['elevation', 'area', 'head', 'power']
+if sea is not None:
+    hydro_all = dict((key, np.full(storage_all.shape, np.nan)) for key in list_hydro_keys)
+# operational diagnostics of each dam, accumulated over time chunks (see my_functions.DIAGNOSTIC_NAMES)
+ndiag = len(my_functions.DIAGNOSTIC_NAMES)
+diagnostics_all = np.zeros((nrun, len(list_dams), ndiag))
+# mass-balance residual of each dam against the output flow field and storage, accumulated over
+# time chunks (see my_functions.calc_mass_balance_residual) [acre-feet]
+mass_balance_all = np.zeros((nrun, len(list_dams)))
+# One delta buffer for each run, sharing the modified cells
+list_delta_store = [dict(delta_store) for r in range(nrun)]
+delta_in_flight = np.zeros((nrun, max_lag, ncell), dtype=delta_dtype)  # lagged flow change beyond
+                                                    # the current chunk [cfs]
+t_first = 0  # first time step to simulate
+
+#=== A checkpoint holds the state at the end of the flow data ===#
+# (storage and flow changes in flight must be at the same time step)
+if cfg['PARAM']['checkpoint_path'] is not None and t_run_end<ntime:
+    print 'Error: end_date_to_run must reach the last date of the flow data to write a checkpoint!'
+    exit()
 
-#=== Save modified streamflow ===#
-ds_flow_new = xray.Dataset({'streamflow': (['time', 'lat', 'lon'], da_flow.values)}, \
-                           coords={'lat': (['lat'], ds_rvic['lat'].values), \
-                                   'lon': (['lon'], ds_rvic['lon'].values), \
-                                   'time': (['time'], da_flow['time'].values)})
-ds_flow_new['streamflow'].attrs['units'] = 'cfs'
-ds_flow_new['streamflow'].attrs['long_name'] = 'Simulated regulated streamflow'
+#=== Restart from the state at the end of an earlier run ===#
+if cfg['PARAM']['restart_checkpoint'] is not None:
+    checkpoint = my_functions.read_checkpoint(cfg['PARAM']['restart_checkpoint'])
+    if not (np.array_equal(checkpoint['dam_numbers'], df_dam_info['dam_number'].values) \
+            and np.array_equal(checkpoint['rows'], delta_store['rows']) \
+            and np.array_equal(checkpoint['cols'], delta_store['cols']) \
+            and checkpoint['S'].shape==S.shape \
+            and 'release' in checkpoint and checkpoint['release'].shape==release_last.shape \
+            and checkpoint['delta_in_flight'].shape==delta_in_flight.shape):
+        print 'Error: checkpoint does not match the dams, network, scenarios or ensemble of this run!'
+        exit()
+    # dams operated before the checkpoint continue from its storage only if the operation
+    # period starts on the same date
+    if checkpoint['start_date']!=pd.Timestamp(start_date_to_run):
+        print 'Error: start_date_to_run must be the same as in the checkpointed run ({})!'.format(\
+                                                                    checkpoint['start_date'])
+        exit()
+    t_first = flow_dates.searchsorted(checkpoint['date']) + 1
+    if t_first>ntime or flow_dates[t_first-1]!=checkpoint['date']:
+        print 'Error: checkpoint date {} is not in the flow data!'.format(checkpoint['date'])
+        exit()
+    S[:] = checkpoint['S']
+    release_last[:] = checkpoint['release']
+    delta_in_flight[:] = checkpoint['delta_in_flight']
+    print 'Restarting from checkpoint of {}'.format(checkpoint['date'])
 
-ds_flow_new.to_netcdf('{}.modified_flow.nc'.format(cfg['OUTPUT']['out_flow_basepath']), \
-                      format='NETCDF4_CLASSIC')
-ds_flow_new.close()
+#=== Create output files (or open them to append, if restarting) ===#
+# the time dimension is only unlimited if a later run may restart from this one and append
+if cfg['PARAM']['restart_checkpoint'] is not None:
+    if cfg['OUTPUT']['output_format']=='grid':
+        list_out_paths = ['{}.modified_flow.nc'.format(cfg['OUTPUT']['out_flow_basepath']), \
+                          '{}.modified_delta_flow.nc'.format(cfg['OUTPUT']['out_flow_basepath'])]
+    else:
+        list_out_paths = ['{}.modified_flow.network.nc'.format(cfg['OUTPUT']['out_flow_basepath'])]
+    try:
+        list_nc = [my_functions.open_nc_append(path, flow_dates[t_first:], checkpoint['date']) \
+                   for path in list_out_paths]
+    except ValueError as e:
+        print 'Error: {}'.format(e)
+        exit()
+    nc_flow, t_offset = list_nc[0]
+    nc_delta = list_nc[-1][0]
+elif cfg['OUTPUT']['output_format']=='grid':
+    nc_flow = my_functions.create_grid_nc(\
+                    '{}.modified_flow.nc'.format(cfg['OUTPUT']['out_flow_basepath']), \
+                    'streamflow', flow_dates, ds_rvic['lat'].values, ds_rvic['lon'].values, \
+                    flow_dtype, units='cfs', long_name='Simulated regulated streamflow', \
+                    scenarios=list_scenarios, members=list_members, \
+                    unlimited_time=cfg['PARAM']['checkpoint_path'] is not None)
+    nc_delta = my_functions.create_grid_nc(\
+                    '{}.modified_delta_flow.nc'.format(cfg['OUTPUT']['out_flow_basepath']), \
+                    'flow_delta', flow_dates, ds_rvic['lat'].values, ds_rvic['lon'].values, \
+                    flow_dtype, units='cfs', \
+                    long_name='Simulated streamflow difference (regulated-unregulated', \
+                    scenarios=list_scenarios, members=list_members, \
+                    unlimited_time=cfg['PARAM']['checkpoint_path'] is not None)
+elif cfg['OUTPUT']['output_format']=='network':
+    # Only modified cells; both variables in one file
+    nc_flow = my_functions.create_network_nc(\
+                    '{}.modified_flow.network.nc'.format(cfg['OUTPUT']['out_flow_basepath']), \
+                    flow_dates, ds_rvic['lat'].values, ds_rvic['lon'].values, \
+                    delta_store['rows'], delta_store['cols'], flow_dtype, \
+                    cfg['INPUT']['rvic_output_path'], scenarios=list_scenarios, \
+                    members=list_members, \
+                    unlimited_time=cfg['PARAM']['checkpoint_path'] is not None)
+    nc_delta = nc_flow
+else:
+    print 'Error: unsupported output format!'
+    exit()
+if cfg['PARAM']['restart_checkpoint'] is None:
+    t_offset = 0  # time index in output files of the first time step to simulate
 
-#=== Save flow change before and after reservoir operation ===#
-ds_flow_delta = xray.Dataset({'flow_delta': (['time', 'lat', 'lon'], \
-                                             da_flow.values-da_rvic_flow.values)}, \
-                             coords={'lat': (['lat'], ds_rvic['lat'].values), \
-                                     'lon': (['lon'], ds_rvic['lon'].values), \
-                                     'time': (['time'], da_flow['time'].values)})
-ds_flow_delta['flow_delta'].attrs['units'] = 'cfs'
-ds_flow_delta['flow_delta'].attrs['long_name'] = 'Simulated streamflow difference (regulated-unregulated'
+#=== Compile downstream routing of each group of dams into sparse matrices, one per lag ===#
+list_routing = [[my_functions.compile_routing_matrices(delta_store, list_lag_days[k], dam_group, \
+                                                      list_lag_weights[k]) \
+                 for dam_group in list_dam_groups] for k in range(nscen)]
 
-ds_flow_delta.to_netcdf('{}.modified_delta_flow.nc'.format(cfg['OUTPUT']['out_flow_basepath']), \
-                        format='NETCDF4_CLASSIC')
-ds_flow_delta.close()
+#=== Loop over each time chunk ===#
+for t0 in range(t_first, ntime, chunk_length):
+    t1 = min(t0+chunk_length, ntime)
+    print 'Simulating time steps {} to {}...'.format(t0, t1-1)
+    #=== Load original flow of this chunk ===#
+    # one member at a time into a preallocated array, so that only one member's read
+    # is held on top of the chunk
+    flow = np.empty((nmember, t1-t0, nlat, nlon), dtype=flow_dtype)  # (member, time, lat, lon)
+    for m, ds in enumerate(list_ds_rvic):
+        flow[m] = ds['streamflow'].isel(time=slice(t0, t1)).values
+    flow *= flow_dtype.type(pow(1000./25.4/12, 3))  # convert m3/s to cfs (in place)
+    #=== Delta buffer of this chunk; starts with flow change still in flight ===#
+    for r in range(nrun):
+        list_delta_store[r]['delta'] = np.zeros((t1-t0+max_lag, ncell), dtype=delta_dtype)
+        list_delta_store[r]['delta'][:max_lag] = delta_in_flight[r]
 
+    #=== Period of this chunk with reservoir operation ===#
+    s0 = max(t0, t_run_start)
+    s1 = min(t1, t_run_end)
+    # inflow to each dam from its first operating time step in the chunk, and storage before it,
+    # for the mass balance against the output flow field and storage
+    dam_inflow = np.zeros((nrun, len(list_dams), t1-t0))  # [cfs]
+    dam_t_start = np.full((nrun, len(list_dams)), t1-t0, dtype=int)  # t1-t0 if not operating
+    storage_before = np.zeros((nrun, len(list_dams)))  # [acre-feet]
 
+    #=== Loop over each group of dams ===#
+    for g, dam_group in enumerate(list_dam_groups):
+        if s0 >= s1:
+            break
+        list_i = [i for i in dam_group if list_dams[i]['t_start']<s1]  # dams operating
+        if len(list_i)==0:
+            continue
+        # All (run, dam) pairs of the group are simulated as one batch
+        list_ri = [(r, i) for r in range(nrun) for i in list_i]
+        #=== Inflow to each dam (including flow changes from upstream dams) ===#
+        inflow = np.array([flow[list_runs[r][0], s0-t0:s1-t0, \
+                                list_dams[i]['row'], list_dams[i]['col']] \
+                           + list_delta_store[r]['delta'][s0-t0:s1-t0, list_dams[i]['cell']] \
+                           for r, i in list_ri])  # [cfs]
+        rule_curve = np.array([list_dams[i]['rule_curve'][s0-t_run_start:s1-t_run_start] \
+                               * scenario['rule_curve_scale'][list_runs[r][1], i] \
+                               for r, i in list_ri]) * 43560.0  # convert [acre-feet] to [ft3]
+        #=== Initial storage and last release ===#
+        # dams starting in this chunk start from the rule curve value of the first time step
+        # of operation (with no earlier release); others continue from the end of the previous chunk
+        start_index = np.array([max(0, list_dams[i]['t_start']-s0) for r, i in list_ri])
+        init_S = np.array([list_dams[i]['rule_curve'][list_dams[i]['t_start']-t_run_start] \
+                           * scenario['rule_curve_scale'][list_runs[r][1], i] * 43560.0 \
+                           if list_dams[i]['t_start']>=s0 else S[r, i] \
+                           for r, i in list_ri])
+        init_release = np.array([np.nan if list_dams[i]['t_start']>=s0 else release_last[r, i] \
+                                 for r, i in list_ri])
+        top_vol = np.array([scenario['top_vol'][list_runs[r][1], i] for r, i in list_ri]) * 43560.0
+        bot_vol = np.array([scenario['bot_vol'][list_runs[r][1], i] for r, i in list_ri]) * 43560.0
+        max_flow = np.array([scenario['max_flow'][list_runs[r][1], i] for r, i in list_ri])
+        min_flow = np.array([scenario['min_flow'][list_runs[r][1], i] for r, i in list_ri])
+        #=== Operating policy of the dams (None for the default policy) ===#
+        if policy_module is not None:
+            policy = policy_module.make_policy(\
+                            [list_dams[i]['dam_number'] for r, i in list_ri], \
+                            [scenario['names'][list_runs[r][1]] for r, i in list_ri], \
+                            flow_dates[s0:s1], dt_seconds)
+        else:
+            policy = None
+        #=== Look up cached results of dams with unchanged inputs ===#
+        list_cached = [None] * len(list_ri)
+        if use_dam_cache:
+            list_key = [my_functions.calc_dam_cache_key(\
+                            inflow[d], rule_curve[d], \
+                            [init_S[d], start_index[d], top_vol[d], bot_vol[d], \
+                             max_flow[d], min_flow[d], dt_seconds], \
+                            delta_store['dam_cells'][i], list_lag_days[list_runs[r][1]][i], \
+                            list_lag_weights[list_runs[r][1]][i]) \
+                        for d, (r, i) in enumerate(list_ri)]
+            list_cached = [my_functions.load_dam_cache(cfg['PARAM']['dam_cache_dir'], key) \
+                           for key in list_key]
+        ind_run = [d for d in range(len(list_ri)) if list_cached[d] is None]
+        #=== Simulate reservoir operation (dams not in cache) ===#
+        release = np.full(inflow.shape, np.nan)
+        storage = np.full(inflow.shape, np.nan)
+        final_S = np.empty(len(list_ri))
+        # water level and hydropower are looked up in the same pass as the release
+        sea_ri = sea.select([i for r, i in list_ri]) if sea is not None else None
+        hydro = dict((key, np.full(inflow.shape, np.nan)) for key in list_hydro_keys)
+        diagnostics = np.zeros((len(list_ri), ndiag))
+        # (policy parameters are checked against the dams they are bound to; ValueError if not valid)
+        if cfg['PARAM']['engine']=='time_major':
+            # Flow changes between dams are routed within the engine; inflow is updated
+            # to include flow changes from upstream dams
+            dict_position = dict(((r, i), d) for d, (r, i) in enumerate(list_ri))
+            list_levels = [[dict_position[(r, i)] for r in range(nrun) for i in level \
+                            if (r, i) in dict_position] for level in dam_levels]
+            # one link for each kernel tap
+            list_links = [(dict_position[(r, i)], dict_position[(r, d)], lag, weight) \
+                          for r in range(nrun) for i, d, j in list_dam_links \
+                          if (r, i) in dict_position and (r, d) in dict_position \
+                          for lag, weight in zip(list_lag_days[list_runs[r][1]][i][j], \
+                                                 list_lag_weights[list_runs[r][1]][i][j])]
+            link_from, link_to, link_lag = [np.array([link[n] for link in list_links], dtype=int) \
+                                            for n in range(3)]
+            link_weight = np.array([link[3] for link in list_links], dtype=float)
+            try:
+                release, storage, inflow = my_functions.simulate_network_time_major(\
+                                inflow, rule_curve, init_S, top_vol, bot_vol, max_flow, min_flow, \
+                                start_index, [level for level in list_levels if len(level)>0], \
+                                link_from, link_to, link_lag, final_S=final_S, \
+                                link_weight=link_weight, dt=dt_seconds, policy=policy, \
+                                sea=sea_ri, hydro=hydro, diagnostics=diagnostics, \
+                                init_release=init_release)
+            except ValueError as e:
+                print 'Error: {}'.format(e)
+                exit()
+        elif len(ind_run)>0:
+            final_S_run = np.empty(len(ind_run))
+            hydro_run = {}
+            diagnostics_run = np.zeros((len(ind_run), ndiag))
+            try:
+                release[ind_run], storage[ind_run] = my_functions.reservoir_operation_kernel_batch(\
+                                inflow[ind_run], rule_curve[ind_run], init_S[ind_run], \
+                                top_vol=top_vol[ind_run], bot_vol=bot_vol[ind_run], \
+                                max_flow=max_flow[ind_run], min_flow=min_flow[ind_run], \
+                                start_index=start_index[ind_run], final_S=final_S_run, \
+                                dt=dt_seconds, \
+                                policy=policy.select(ind_run) if policy is not None else None, \
+                                sea=sea_ri.select(ind_run) if sea is not None else None, \
+                                hydro=hydro_run, diagnostics=diagnostics_run, \
+                                init_release=init_release[ind_run])
+            except ValueError as e:
+                print 'Error: {}'.format(e)
+                exit()
+            final_S[ind_run] = final_S_run
+            diagnostics[ind_run] = diagnostics_run
+            for key in hydro_run:
+                hydro[key][ind_run] = hydro_run[key]
+        for d, (r, i) in enumerate(list_ri):
+            if list_cached[d] is None:
+                if use_dam_cache:
+                    my_functions.save_dam_cache(cfg['PARAM']['dam_cache_dir'], list_key[d], \
+                                                release[d], storage[d], final_S[d], \
+                                                diagnostics[d])
+            else:
+                release[d] = list_cached[d]['release']
+                storage[d] = list_cached[d]['storage']
+                final_S[d] = list_cached[d]['final_S']
+                diagnostics[d] = list_cached[d]['diagnostics']
+                print 'Dam {} unchanged; loaded from cache'.format(list_dams[i]['dam_number'])
+        ind_cached = [d for d in range(len(list_ri)) if list_cached[d] is not None]
+        if sea is not None and len(ind_cached)>0:
+            hydro_cached = sea_ri.select(ind_cached).evaluate(storage[ind_cached], release[ind_cached])
+            for key, values in zip(list_hydro_keys, hydro_cached):
+                hydro[key][ind_cached] = values
+        #=== Collect storage and flow change of each dam ===#
+        dflow = np.zeros((nrun, len(dam_group), s1-s0))  # 0 when not operating
+        for d, (r, i) in enumerate(list_ri):
+            S[r, i] = final_S[d]
+            release_last[r, i] = release[d, -1]
+            dam_t_start[r, i] = s0 - t0 + start_index[d]
+            dam_inflow[r, i, s0-t0+start_index[d]:s1-t0] = inflow[d, start_index[d]:]
+            storage_before[r, i] = init_S[d] / 43560.0
+            diagnostics_all[r, i] = my_functions.combine_diagnostics(diagnostics_all[r, i], \
+                                                                     diagnostics[d])
+            storage_all[r, i, s0-t_run_start:s1-t_run_start] = storage[d]
+            if sea is not None:
+                for key in list_hydro_keys:
+                    hydro_all[key][r, i, s0-t_run_start:s1-t_run_start] = hydro[key][d]
+            dflow[r, dam_group.index(i), start_index[d]:] = \
+                    release[d, start_index[d]:] - inflow[d, start_index[d]:]
+        #=== Route flow changes to the dam cells and downstream cells ===#
+        for r, (m, k) in enumerate(list_runs):
+            my_functions.add_routed_delta(list_delta_store[r]['delta'], list_routing[k][g], \
+                                          s0-t0, dflow[r])
+
+    #=== Add flow changes onto the flow field and save this chunk ===#
+    # only the modified cells are kept before modification, to compute the flow change
+    flow_orig_cells = flow[:, :, delta_store['rows'], delta_store['cols']]  # (member, time, cell)
+    for r, (m, k) in enumerate(list_runs):
+        delta_in_flight[r] = list_delta_store[r]['delta'][t1-t0:]
+        i_member = m if list_members is not None else None
+        i_scenario = k if list_scenarios is not None else None
+        flow[m][:, delta_store['rows'], delta_store['cols']] = flow_orig_cells[m]
+        my_functions.apply_sparse_delta(flow[m], list_delta_store[r])
+        flow_cells = flow[m][:, delta_store['rows'], delta_store['cols']]
+        for i in range(len(list_dams)):
+            if dam_t_start[r, i]<s1-t0:
+                mass_balance_all[r, i] += my_functions.calc_mass_balance_residual(\
+                        dam_inflow[r, i, dam_t_start[r, i]:s1-t0], \
+                        flow_cells[dam_t_start[r, i]:s1-t0, list_dams[i]['cell']], \
+                        storage_before[r, i], storage_all[r, i, s1-1-t_run_start], dt_seconds)
+        t_out = t0 - t_first + t_offset  # time index in output files
+        if cfg['OUTPUT']['output_format']=='grid':
+            my_functions.write_grid_nc_chunk(nc_flow, 'streamflow', t_out, flow[m], \
+                                             i_scenario, i_member)
+            my_functions.write_delta_nc_chunk(nc_delta, 'flow_delta', t_out, flow[m], \
+                                delta_store['rows'], delta_store['cols'], \
+                                flow_cells - flow_orig_cells[m], \
+                                i_scenario=i_scenario, i_member=i_member)
+        else:
+            my_functions.write_grid_nc_chunk(nc_flow, 'streamflow', t_out, flow_cells, \
+                                             i_scenario, i_member)
+            my_functions.write_grid_nc_chunk(nc_delta, 'flow_delta', t_out, \
+                                             flow_cells - flow_orig_cells[m], \
+                                             i_scenario, i_member)
+    del flow  # release the chunk before reading the next one
+
+nc_flow.close()
+if nc_delta is not nc_flow:
+    nc_delta.close()
+
+#=== Save state at the end of this run, for a later run to restart from ===#
+if cfg['PARAM']['checkpoint_path'] is not None:
+    my_functions.write_checkpoint(cfg['PARAM']['checkpoint_path'], flow_dates[ntime-1], \
+                                  start_date_to_run, \
+                                  df_dam_info['dam_number'].values, S, release_last, delta_in_flight, \
+                                  delta_store['rows'], delta_store['cols'])
+
+#====================================================================#
+# Save storage of each dam
+#====================================================================#
+for r, (m, k) in enumerate(list_runs):
+    storage_basepath = cfg['OUTPUT']['out_flow_basepath']
+    if list_members is not None:
+        storage_basepath = '{}.member{}'.format(storage_basepath, m)
+    if list_scenarios is not None:
+        storage_basepath = '{}.{}'.format(storage_basepath, list_scenarios[k])
+    for i, dam in enumerate(list_dams):
+        if not dam['operated']:
+            continue
+        # only the period simulated in this run (appended to the file, if restarting)
+        t_save = max(dam['t_start'], t_first)
+        if t_save>=t_run_end:
+            continue
+        s_storage = pd.Series(storage_all[r, i, t_save-t_run_start:], \
+                              index=dates_to_run[t_save-t_run_start:])
+        df = pd.DataFrame()
+        df['year'] = s_storage.index.year
+        df['month'] = s_storage.index.month
+        df['day'] = s_storage.index.day
+        columns = ['year', 'month', 'day']
+        if dt_seconds<86400:  # sub-daily
+            df['hour'] = s_storage.index.hour
+            columns.append('hour')
+        df['storage_acre_ft'] = s_storage.values
+        columns.append('storage_acre_ft')
+        if sea is not None and not np.isnan(sea.storage[i, 0]):  # dam with table
+            df['elevation_ft'] = hydro_all['elevation'][r, i, t_save-t_run_start:]
+            df['area_acres'] = hydro_all['area'][r, i, t_save-t_run_start:]
+            df['head_ft'] = hydro_all['head'][r, i, t_save-t_run_start:]
+            df['power_mw'] = hydro_all['power'][r, i, t_save-t_run_start:]
+            df['energy_mwh'] = df['power_mw'] * dt_seconds / 3600.0
+            columns += ['elevation_ft', 'area_acres', 'head_ft', 'power_mw', 'energy_mwh']
+        storage_path = '{}.storage.dam{}.txt'.format(storage_basepath, dam['dam_number'])
+        append = t_first>0 and os.path.isfile(storage_path)
+        df[columns].\
+                to_csv(storage_path, sep='\t', index=False, \
+                       mode='a' if append else 'w', header=not append)
+
+
+#====================================================================#
+# Save summary table of operational diagnostics of each dam
+#====================================================================#
+# one row for each (member, scenario, dam) operated in the period simulated in this run
+# (appended to the table, if restarting)
+list_rows = []
+for r, (m, k) in enumerate(list_runs):
+    for i, dam in enumerate(list_dams):
+        t_save = max(dam['t_start'], t_first)
+        if not dam['operated'] or t_save>=t_run_end:
+            continue
+        row = []
+        if list_members is not None:
+            row.append(m)
+        if list_scenarios is not None:
+            row.append(list_scenarios[k])
+        row += [dam['dam_number'], dam['dam_name'], \
+                flow_dates[t_save].strftime('%Y-%m-%d %H:%M'), \
+                dates_to_run[-1].strftime('%Y-%m-%d %H:%M')]
+        list_rows.append(row + diagnostics_all[r, i].tolist() + [mass_balance_all[r, i]])
+columns = (['member'] if list_members is not None else []) \
+          + (['scenario'] if list_scenarios is not None else []) \
+          + ['dam_number', 'dam_name', 'first_date', 'last_date'] + my_functions.DIAGNOSTIC_NAMES \
+          + ['mass_balance_residual_acre_ft']
+df_diagnostics = pd.DataFrame(list_rows, columns=columns)
+diagnostics_path = '{}.diagnostics.txt'.format(cfg['OUTPUT']['out_flow_basepath'])
+append = t_first>0 and os.path.isfile(diagnostics_path)
+df_diagnostics.to_csv(diagnostics_path, sep='\t', index=False, \
+                      mode='a' if append else 'w', header=not append)
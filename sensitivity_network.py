@@ -0,0 +1,147 @@
+#!/usr/local/anaconda/bin/python
+
+# This script runs a global sensitivity analysis (Sobol or Morris) of daily flow at chosen cells to dam parameters and wave velocity. Samples are simulated in memory in batches (my_functions.simulate_gauge_flow) in parallel worker processes, and reduced to flow statistics at the chosen cells; no flow grid is written
+
+import sys
+import numpy as np
+import pandas as pd
+import multiprocessing
+import my_functions
+
+# Default values of optional config options
+default_config = {'NETWORK': {'lag_method': 'round', \
+                              'diffusion': None, \
+                              'muskingum_x': None}, \
+                  'SENSITIVITY': {'method': 'sobol', \
+                                  'sens_dams': None, \
+                                  'max_flow_range': None, \
+                                  'min_flow_range': None, \
+                                  'top_vol_range': None, \
+                                  'bot_vol_range': None, \
+                                  'rule_curve_offset_range': None, \
+                                  'wave_velocity_range': None, \
+                                  'n_base': 64, \
+                                  'n_trajectories': 20, \
+                                  'n_levels': 4, \
+                                  'batch_size': 16, \
+                                  'n_workers': 1, \
+                                  'seed': 0}}
+
+# Read in config file (same as reservoir_network.py, with a [SENSITIVITY] section)
+cfg = my_functions.read_config(sys.argv[1], default_config=default_config)
+if 'SENSITIVITY' not in cfg:
+    print 'Error: [SENSITIVITY] section is needed!'
+    exit()
+if cfg['SENSITIVITY']['method'] not in ['sobol', 'morris']:
+    print 'Error: unsupported sensitivity method!'
+    exit()
+
+#====================================================================#
+# Load dam and cell information, and prepare the in-memory problem
+#====================================================================#
+#=== Load dam info and info of the cells to analyze ===#
+df_dam_info = pd.read_csv(cfg['DAM_INFO']['dam_info_csv'])
+df_cell_info = pd.read_csv(cfg['SENSITIVITY']['cell_csv'])
+ndam = len(df_dam_info)
+ncell = len(df_cell_info)
+#=== Natural flow, rule curves and routing to analyzed cells over the analysis period ===#
+try:
+    problem, routing, dates_to_run = my_functions.setup_gauge_problem(\
+                                        cfg, df_dam_info, df_cell_info['grid_lat'].values, \
+                                        df_cell_info['grid_lon'].values)
+except ValueError as e:
+    print 'Error: {}'.format(e)
+    exit()
+ndays = len(np.unique(dates_to_run.normalize()))
+
+#=== Variables: (name, dam index) and range ===#
+# dam parameters are factors multiplied to the defaults (rule curve offset is a fraction of
+# top_vol - bot_vol added to the rule curve); wave velocity is in m/s, for all dams
+if cfg['SENSITIVITY']['sens_dams'] is None:
+    list_sens_dams = range(ndam)
+else:
+    list_sens_dams = [list(df_dam_info['dam_number'].values).index(n) \
+                      for n in np.atleast_1d(cfg['SENSITIVITY']['sens_dams'])]
+list_variables = []
+list_range = []
+for name in ['max_flow', 'min_flow', 'top_vol', 'bot_vol', 'rule_curve_offset']:
+    if cfg['SENSITIVITY']['{}_range'.format(name)] is None:
+        continue
+    for i in list_sens_dams:
+        list_variables.append((name, i))
+        list_range.append(cfg['SENSITIVITY']['{}_range'.format(name)])
+if cfg['SENSITIVITY']['wave_velocity_range'] is not None:
+    list_variables.append(('wave_velocity', -1))
+    list_range.append(cfg['SENSITIVITY']['wave_velocity_range'])
+if len(list_variables)==0:
+    print 'Error: no variables (set at least one of the *_range options)!'
+    exit()
+nvar = len(list_variables)
+lower = np.array([r[0] for r in list_range], dtype=float)
+upper = np.array([r[1] for r in list_range], dtype=float)
+variable_names = [name if i<0 else '{}_dam{}'.format(name, df_dam_info.ix[i]['dam_number']) \
+                  for name, i in list_variables]
+print 'Variables: {}'.format(variable_names)
+problem['variables'] = list_variables
+
+#====================================================================#
+# Generate samples and evaluate them in parallel batches
+#====================================================================#
+# statistics of daily flow at each analyzed cell, reduced from each sample in memory
+list_stats = ['mean', 'max', 'min']
+
+def evaluate(samples):
+    ''' Statistics of daily flow at each analyzed cell for each sample (sample, cell, statistic) [cfs]; worker processes inherit the problem '''
+    if list_variables[-1][0]=='wave_velocity':
+        networks = [my_functions.compile_gauge_routing(routing, velocity) \
+                    for velocity in samples[:, -1]]
+    else:
+        networks = None
+    cell_flow = my_functions.simulate_gauge_flow(problem, samples, networks)
+    # daily mean of each cell
+    cell_flow = cell_flow.reshape(len(samples), ncell, ndays, -1).mean(axis=3)
+    return np.stack([cell_flow.mean(axis=2), cell_flow.max(axis=2), cell_flow.min(axis=2)], axis=2)
+
+random_state = np.random.RandomState(cfg['SENSITIVITY']['seed'])
+if cfg['SENSITIVITY']['method']=='sobol':
+    unit_samples = my_functions.sample_sobol(cfg['SENSITIVITY']['n_base'], nvar, random_state)
+else:
+    unit_samples = my_functions.sample_morris(cfg['SENSITIVITY']['n_trajectories'], nvar, \
+                                              cfg['SENSITIVITY']['n_levels'], random_state)
+samples = lower + unit_samples * (upper - lower)
+print 'Evaluating {} samples...'.format(len(samples))
+batch_size = cfg['SENSITIVITY']['batch_size']
+list_batch = [samples[s:s+batch_size] for s in range(0, len(samples), batch_size)]
+if cfg['SENSITIVITY']['n_workers']>1:
+    pool = multiprocessing.Pool(cfg['SENSITIVITY']['n_workers'])
+    stats = np.concatenate(pool.map(evaluate, list_batch))
+    pool.close()
+else:
+    stats = np.concatenate([evaluate(batch) for batch in list_batch])
+
+#====================================================================#
+# Calculate sensitivity indices and save results
+#====================================================================#
+cell_names = [str(name) for name in df_cell_info['cell_name'].values]
+#=== Samples and their flow statistics ===#
+df_samples = pd.DataFrame(np.concatenate([samples, stats.reshape(len(samples), -1)], axis=1), \
+                          columns=variable_names + ['{}_{}'.format(stat, name) for name in cell_names \
+                                                    for stat in list_stats])
+df_samples.to_csv('{}.samples.txt'.format(cfg['SENSITIVITY']['out_basepath']), sep='\t', index=False)
+
+#=== Indices of each variable for each cell and statistic ===#
+if cfg['SENSITIVITY']['method']=='sobol':
+    index_names = ['S1', 'ST']
+    indices = my_functions.calc_sobol_indices(stats, nvar)
+else:
+    index_names = ['mu', 'mu_star', 'sigma']
+    indices = my_functions.calc_morris_indices(unit_samples, stats, nvar)
+list_records = []
+for c in range(ncell):
+    for s in range(len(list_stats)):
+        for v in range(nvar):
+            list_records.append([cell_names[c], list_stats[s], variable_names[v]] \
+                                + [index[v, c, s] for index in indices])
+df_indices = pd.DataFrame(list_records, columns=['cell_name', 'statistic', 'variable'] + index_names)
+df_indices.to_csv('{}.indices.txt'.format(cfg['SENSITIVITY']['out_basepath']), sep='\t', index=False)
+print 'Done!'